@@ -1,31 +1,12 @@
 import pathlib
-from pathlib import Path
 
 import docker
-from aws_cdk import aws_lambda, aws_s3, core
+from aws_cdk import aws_lambda, core
 from aws_cdk.aws_apigatewayv2 import HttpApi, HttpMethod
 from aws_cdk.aws_apigatewayv2_integrations import LambdaProxyIntegration
-from pydantic import BaseSettings
 
-code_dir = pathlib.Path(__file__).parent.absolute()
-parent = code_dir.parent.absolute()
-env_file = Path.joinpath(parent, ".env")
-
-
-class Settings(BaseSettings):
-    DATABASE_URL: str
-    DATABASE_WRITE_URL: str
-    OPENAQ_ENV: str = "staging"
-    OPENAQ_FASTAPI_URL: str
-    TESTLOCAL: bool = True
-    OPENAQ_FETCH_BUCKET: str
-    OPENAQ_ETL_BUCKET: str
+from settings import settings
 
-    class Config:
-        env_file = env_file
-
-
-settings = Settings()
 OPENAQ_FETCH_BUCKET = "openaq-fetches"
 
 
@@ -33,12 +14,21 @@ code_dir = pathlib.Path(__file__).parent.absolute()
 docker_dir = code_dir.parent.absolute()
 
 
-def dictstr(item):
-    return item[0], str(item[1])
+# settings that only steer the deploy, the lambdas never read them
+DEPLOY_ONLY = {"ENABLE_INGEST"}
+
 
+def build_env():
+    """Lambda environment from settings, leaving out unset values."""
+    env = {}
+    for key, value in settings.dict().items():
+        if key in DEPLOY_ONLY or value is None or value == "":
+            continue
+        env[key] = value if isinstance(value, str) else str(value)
+    return env
 
-env = dict(map(dictstr, settings.dict().items()))
-print(env)
+
+env = build_env()
 
 # create package using docker
 client = docker.from_env()
@@ -62,9 +52,6 @@ stagingpackage = aws_lambda.Code.asset(
 prodpackage = aws_lambda.Code.asset(
     str(pathlib.Path.joinpath(code_dir, "package.zip"))
 )
-ingestpackage = aws_lambda.Code.asset(
-    str(pathlib.Path.joinpath(code_dir, "package.zip"))
-)
 
 
 class LambdaApiStack(core.Stack):
@@ -122,6 +109,9 @@ class LambdaIngestStack(core.Stack):
         **kwargs,
     ) -> None:
         """Define stack."""
+        # only needed for ingest deploys
+        from aws_cdk import aws_s3
+
         super().__init__(scope, id, *kwargs)
 
         ingest_function = aws_lambda.Function(
@@ -147,13 +137,17 @@ app = core.App()
 print(f"openaq-lcs-api{settings.OPENAQ_ENV}")
 staging = LambdaApiStack(app, "openaq-lcs-apistaging", package=stagingpackage)
 prod = LambdaApiStack(app, "openaq-lcs-api", package=prodpackage)
-ingest = LambdaIngestStack(
-    app, f"openaq-lcs-ingest{settings.OPENAQ_ENV}", package=ingestpackage
-)
 core.Tags.of(staging).add("devseed", "true")
 core.Tags.of(staging).add("lcs", "true")
-core.Tags.of(ingest).add("devseed", "true")
-core.Tags.of(ingest).add("lcs", "true")
+if settings.ENABLE_INGEST:
+    ingestpackage = aws_lambda.Code.asset(
+        str(pathlib.Path.joinpath(code_dir, "package.zip"))
+    )
+    ingest = LambdaIngestStack(
+        app, f"openaq-lcs-ingest{settings.OPENAQ_ENV}", package=ingestpackage
+    )
+    core.Tags.of(ingest).add("devseed", "true")
+    core.Tags.of(ingest).add("lcs", "true")
 core.Tags.of(prod).add("devseed", "true")
 core.Tags.of(prod).add("lcs", "true")
 app.synth()
@@ -13,6 +13,7 @@ class Settings(BaseSettings):
     TESTLOCAL: bool = True
     OPENAQ_FETCH_BUCKET: str
     OPENAQ_ETL_BUCKET: str
+    ENABLE_INGEST: bool = True
 
     class Config:
         env_file = env_file
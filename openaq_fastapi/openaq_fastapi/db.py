@@ -1,17 +1,24 @@
 import logging
+import re
 import time
 import os
+from functools import lru_cache
 
 import asyncpg
 import orjson
 from aiocache import SimpleMemoryCache, cached
 from aiocache.plugins import HitMissRatioPlugin, TimingPlugin
-from buildpg import render
 from fastapi import HTTPException, Request
+from starlette.responses import Response
 
 from .settings import settings
 
-from .models.responses import Meta, OpenAQResult
+from .models.responses import (
+    Meta,
+    OpenAQResult,
+    openaq_body,
+    openaq_response,
+)
 
 logger = logging.getLogger("base")
 logger.setLevel(logging.DEBUG)
@@ -42,14 +49,73 @@ cache_config = {
 }
 
 
+# string literals are matched first so a :name inside quotes is kept
+NAMED_PARAM = re.compile(r"'(?:[^']|'')*'|(?<![:\w]):([a-zA-Z_]\w*)")
+
+
+@lru_cache(maxsize=256)
+def positional(query):
+    """Rewrite :name placeholders as asyncpg $N placeholders.
+
+    Returns the rewritten query along with the parameter name bound at
+    each position. Query text is built from a small set of templates so
+    the rewrite is only done once per distinct query.
+    """
+    names = []
+
+    def bind(match):
+        if match.group(1) is None:
+            return match.group(0)
+        names.append(match.group(1))
+        return f"${len(names)}"
+
+    return NAMED_PARAM.sub(bind, query), tuple(names)
+
+
+# binary jsonb is a version byte followed by the json text
+JSONB_VERSION = b"\x01"
+
+
+def jsonb_encoder(obj):
+    if isinstance(obj, str):
+        return JSONB_VERSION + obj.encode()
+    return JSONB_VERSION + orjson.dumps(obj)
+
+
+def jsonb_decoder(data):
+    # orjson parses the utf-8 bytes directly, no str is made in between
+    return orjson.loads(memoryview(data)[1:])
+
+
+async def init_connection(con):
+    # api queries are short, jit compiling them costs more than it saves
+    await con.execute("SET jit = off;")
+    # decode jsonb once per value in the driver rather than
+    # handing every row back as a string to be parsed
+    await con.set_type_codec(
+        "jsonb",
+        encoder=jsonb_encoder,
+        decoder=jsonb_decoder,
+        schema="pg_catalog",
+        format="binary",
+    )
+
+
 async def db_pool(pool):
     if pool is None:
         pool = await asyncpg.create_pool(
             settings.DATABASE_URL,
             command_timeout=14,
-            max_inactive_connection_lifetime=15,
-            min_size=1,
-            max_size=10,
+            max_inactive_connection_lifetime=(
+                settings.DATABASE_POOL_INACTIVE_LIFETIME
+            ),
+            min_size=settings.DATABASE_POOL_MIN,
+            max_size=settings.DATABASE_POOL_MAX,
+            # query text is stable per request shape, keep the prepared
+            # statements around for as long as the connection lives
+            statement_cache_size=1024,
+            max_cached_statement_lifetime=0,
+            init=init_connection,
         )
     return pool
 
@@ -70,10 +136,14 @@ class DB:
 
     @cached(900, **cache_config)
     async def fetch(self, query, kwargs):
+        return await self.fetch_uncached(query, kwargs)
+
+    async def fetch_uncached(self, query, kwargs):
         pool = await self.pool()
         start = time.time()
         logger.debug("Start time: %s Query: %s Args:%s", start, query, kwargs)
-        rquery, args = render(query, **kwargs)
+        rquery, names = positional(query)
+        args = [kwargs[n] for n in names]
         async with pool.acquire() as con:
             try:
                 r = await con.fetch(rquery, *args)
@@ -99,29 +169,49 @@ class DB:
         r = await self.fetch(query, kwargs)
         if len(r) > 0:
             return r[0]
-        return []
+        return None
 
     async def fetchval(self, query, kwargs):
         r = await self.fetchrow(query, kwargs)
-        if len(r) > 0:
+        if r:
             return r[0]
         return None
 
-    async def fetchOpenAQResult(self, query, kwargs):
-        rows = await self.fetch(query, kwargs)
+    async def fetchOpenAQRows(self, query, kwargs, fetch=None):
+        rows = await (fetch or self.fetch)(query, kwargs)
 
         if len(rows) == 0:
-            found = 0
-            results = []
-        else:
-            found = rows[0]["count"]
-            # results = [orjson.dumps(r[1]) for r in rows]
-            if len(rows) > 0 and rows[0][1] is not None:
-                results = [
-                    orjson.loads(r[1]) for r in rows if isinstance(r[1], str)
-                ]
-            else:
-                results = []
+            return 0, []
+        first = rows[0]
+        if len(rows) == 1 and "results" in first.keys():
+            # the page was aggregated into a single jsonb array, decoded
+            # in one go by the connection codec
+            return first[0] or 0, first[1]
+        # every result query returns a non null jsonb column which
+        # is already decoded by the connection codec
+        return first[0], [r[1] for r in rows]
+
+    @cached(900, namespace="body", **cache_config)
+    async def fetchOpenAQBody(self, query, kwargs):
+        # only the body is cached, the rows it is built from are not kept
+        found, results = await self.fetchOpenAQRows(
+            query, kwargs, fetch=self.fetch_uncached
+        )
+        page, limit = kwargs["page"], kwargs["limit"]
+        if isinstance(results, bytes):
+            # results already encoded as json by the database
+            return openaq_body(results, found=found, page=page, limit=limit)
+        return openaq_response(
+            results, found=found, page=page, limit=limit
+        ).body
+
+    async def fetchOpenAQResponse(self, query, kwargs):
+        # repeated requests reuse the serialized body, not just the rows
+        body = await self.fetchOpenAQBody(query, kwargs)
+        return Response(body, media_type="application/json")
+
+    async def fetchOpenAQResult(self, query, kwargs):
+        found, results = await self.fetchOpenAQRows(query, kwargs)
 
         meta = Meta(
             website=os.getenv("APP_HOST", "/"),
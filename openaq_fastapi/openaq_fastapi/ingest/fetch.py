@@ -1,20 +1,39 @@
-import gzip
 import io
 import json
 import os
+import struct
 import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import lru_cache, partial
+from multiprocessing import Pool
 
 import boto3
+import orjson
+from boto3.s3.transfer import TransferConfig
 import psycopg2
 import typer
 
 from ..settings import settings
 from .utils import (
-    StringIteratorIO,
+    COPY_HEADER,
+    COPY_TRAILER,
+    NULL,
+    BytesIteratorIO,
+    background,
     check_if_done,
-    clean_csv_value,
+    copy_bool,
+    copy_float8,
+    copy_int4,
+    copy_jsonb,
+    copy_point,
+    copy_text,
+    copy_timestamptz,
     get_query,
+    join_batches,
+    parse_timestamp,
     load_fail,
     load_success,
 )
@@ -25,10 +44,61 @@ dir_path = os.path.dirname(os.path.realpath(__file__))
 
 
 FETCH_BUCKET = settings.OPENAQ_FETCH_BUCKET
-s3 = boto3.resource("s3")
+# clients, unlike resources, are safe to share between threads
+s3c = boto3.client("s3")
+
+# objects larger than this are read as concurrent byte ranges
+RANGE_SIZE = 8 * 1024 * 1024
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=RANGE_SIZE,
+    multipart_chunksize=RANGE_SIZE,
+    max_concurrency=4,
+)
+
+# rows joined together into each chunk of the COPY stream
+COPY_BATCH_ROWS = 4096
+# bytes psycopg2 reads from the stream per call, its default is 8KB
+COPY_READ_SIZE = 1024 * 1024
+FIELD_COUNT = struct.pack(">h", 14)
+DATA_FIELD_COUNT = struct.pack(">h", 2)
 
 
-def parse_json(j):
+def loads(line):
+    # orjson is much faster than json but rejects the NaN/Infinity
+    # literals that json accepts, fall back to json for those lines
+    try:
+        return orjson.loads(line)
+    except orjson.JSONDecodeError:
+        return json.loads(line)
+
+
+@lru_cache(maxsize=4096)
+def parse_date(value):
+    """
+    Parsed datetime and COPY field for a date.utc string. Each feed
+    reports every location at the same few timestamps, so this is only
+    done once per distinct string.
+    """
+    date = parse_timestamp(value)
+    return date, copy_timestamptz(date)
+
+
+def parse_json(j, start=None, end=None):
+    """
+    Build the binary COPY row for a measurement, returned along with
+    its encoded data object which is copied separately. Measurements at
+    or before start or after end would only be deleted by
+    fetch_filter.sql, they are skipped here and return None.
+    """
+    date = j["date"]["utc"]
+    if date is not None and date != "":
+        date, date_field = parse_date(date)
+        if (start is not None and date <= start) or (
+            end is not None and date > end
+        ):
+            return None
+    else:
+        date_field = NULL
     location = j.pop("location", None)
     value = j.pop("value", None)
     unit = j.pop("unit", None)
@@ -36,7 +106,6 @@ def parse_json(j):
     country = j.pop("country", None)
     city = j.pop("city", None)
     source_name = j.pop("sourceName", None)
-    date = j["date"]["utc"]
     j.pop("date", None)
     source_type = j.pop("sourceType", None)
     mobile = j.pop("mobile", None)
@@ -51,63 +120,232 @@ def parse_json(j):
         and "latitude" in j["coordinates"]
     ):
         c = j.pop("coordinates")
-        coords = "".join(
-            (
-                "SRID=4326;POINT(",
-                str(c["longitude"]),
-                " ",
-                str(c["latitude"]),
-                ")",
-            )
+        coords = copy_point(c["longitude"], c["latitude"])
+    else:
+        coords = copy_point(None, None)
+
+    data = orjson.dumps(j)
+
+    # one tuple of the binary COPY stream, in fetch_copy.sql order
+    # without the trailing data_id
+    row = b"".join(
+        (
+            FIELD_COUNT,
+            copy_text(location),
+            copy_float8(value),
+            copy_text(unit),
+            copy_text(parameter),
+            copy_text(country),
+            copy_text(city),
+            copy_text(source_name),
+            date_field,
+            coords,
+            copy_text(source_type),
+            copy_bool(mobile),
+            copy_text(avpd_unit),
+            copy_float8(avpd_value),
         )
+    )
+    return row, data
+
+
+def parse_line(line, start=None, end=None):
+    return parse_json(loads(line), start, end)
+
+
+@lru_cache(maxsize=None)
+def parse_pool():
+    return Pool(processes=settings.FETCH_PARSE_PROCESSES)
+
+
+def parse_lines(f, start=None, end=None):
+    """
+    Parse the lines of a fetch file into COPY rows, in worker processes
+    when FETCH_PARSE_PROCESSES is set. Row order does not matter to the
+    ingest. The pool is opt in as multiprocessing is not available on
+    Lambda, which has no /dev/shm.
+    """
+    parse = partial(parse_line, start=start, end=end)
+    if settings.FETCH_PARSE_PROCESSES > 1:
+        rows = parse_pool().imap_unordered(parse, f, chunksize=2048)
     else:
-        coords = None
-
-    data = json.dumps(j)
-
-    row = [
-        location,
-        value,
-        unit,
-        parameter,
-        country,
-        city,
-        data,
-        source_name,
-        date,
-        coords,
-        source_type,
-        mobile,
-        avpd_unit,
-        avpd_value,
-    ]
-    linestr = "\t".join(map(clean_csv_value, row)) + "\n"
-    return linestr
+        rows = map(parse, f)
+    return filter(None, rows)
+
+
+def with_data_ids(parsed, data_ids, first_id=0):
+    """
+    Finish each parsed row with the id of its data object. Each
+    distinct object is numbered once in data_ids, after first_id,
+    feeds repeat the same metadata for every measurement of a sensor.
+    """
+    for row, data in parsed:
+        data_id = data_ids.get(data)
+        if data_id is None:
+            data_id = data_ids[data] = first_id + len(data_ids) + 1
+        yield row + copy_int4(data_id)
+
+
+def data_rows(data_ids):
+    for data, data_id in data_ids.items():
+        yield DATA_FIELD_COUNT + copy_int4(data_id) + copy_jsonb(data)
 
 
 def create_staging_table(cursor):
     cursor.execute(get_query("fetch_staging.sql"))
 
 
+def read_object(key):
+    """
+    Read an object from the fetch bucket, objects larger than
+    RANGE_SIZE are downloaded as concurrent ranged parts by boto3.
+    """
+    buffer = io.BytesIO()
+    s3c.download_fileobj(FETCH_BUCKET, key, buffer, Config=TRANSFER_CONFIG)
+    return buffer.getvalue()
+
+
+def gunzip(data):
+    """
+    Decompress gzip data, including files of several gzip members,
+    with one zlib call per member. gzip.decompress on older pythons
+    inflates through GzipFile in small reads.
+    """
+    parts = []
+    while data:
+        d = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        parts.append(d.decompress(data))
+        # gzip allows zero padding after the last member
+        data = d.unused_data.lstrip(b"\x00")
+    return b"".join(parts)
+
+
+def download(key):
+    """Download and decompress a fetch file into memory."""
+    return io.BytesIO(gunzip(read_object(key)))
+
+
+def download_or_error(key):
+    """Download a fetch file, returning the error instead of raising it."""
+    try:
+        return download(key)
+    except Exception as e:
+        return e
+
+
+def prefetch(keys):
+    """
+    Yield (key, file) for each key in order while the following
+    FETCH_PREFETCH_FILES files are downloaded in the background. Each
+    file is held decompressed in memory, so besides the file being
+    copied up to FETCH_PREFETCH_FILES more are held at a time, along
+    with the few batches of rows copy_stream buffers. A file that
+    could not be downloaded is yielded as the error instead, so one
+    failed download does not end the iteration for the keys after it.
+    """
+    ahead = max(settings.FETCH_PREFETCH_FILES, 1)
+    with ThreadPoolExecutor(max_workers=ahead) as executor:
+        pending = deque()
+        for key in keys:
+            pending.append((key, executor.submit(download_or_error, key)))
+            if len(pending) > ahead:
+                key, future = pending.popleft()
+                yield key, future.result()
+        while pending:
+            key, future = pending.popleft()
+            yield key, future.result()
+
+
+def copy_stream(rows):
+    """
+    Binary COPY input of rows. The rows are built in a background
+    thread so parsing the next batch overlaps psycopg2 sending the
+    last one.
+    """
+
+    def stream():
+        yield COPY_HEADER
+        yield from background(join_batches(rows, COPY_BATCH_ROWS))
+        yield COPY_TRAILER
+
+    return BytesIteratorIO(stream())
+
+
+def copy_files(cursor, files):
+    """
+    Copy an iterable of (key, file) pairs into tempfetchdata as one
+    COPY stream. If the copy fails, the files are copied again one at
+    a time so a bad file only fails itself rather than the batch.
+    Pairs holding an exception in place of the file, from a failed
+    download, are recorded as failed and left out of the copy.
+    """
+    cursor.execute(get_query("fetch_bounds.sql"))
+    start, end = cursor.fetchone()
+    # data ids carry on from any files already copied into the tables
+    cursor.execute("SELECT coalesce(max(data_id), 0) FROM tempfetchdata_data;")
+    (first_id,) = cursor.fetchone()
+    files = iter(files)
+    keys = []
+    failed = []
+    data_ids = {}
+
+    def rows():
+        for key, f in files:
+            if isinstance(f, Exception):
+                failed.append((key, f))
+                continue
+            print(f"Copying data for {key}")
+            keys.append(key)
+            yield from parse_lines(f, start, end)
+
+    # a failed copy aborts the transaction, the savepoint lets it go on
+    cursor.execute("SAVEPOINT copy_files;")
+    try:
+        query = get_query("fetch_copy.sql")
+        # closing the stream stops its background thread if the copy
+        # gives up before reading all of it
+        rows_ids = with_data_ids(rows(), data_ids, first_id)
+        with copy_stream(rows_ids) as stream:
+            cursor.copy_expert(query, stream, size=COPY_READ_SIZE)
+        status = cursor.statusmessage
+        print("status:", status)
+        with copy_stream(data_rows(data_ids)) as stream:
+            cursor.copy_expert(
+                get_query("fetch_copy_data.sql"), stream, size=COPY_READ_SIZE
+            )
+        cursor.execute("RELEASE SAVEPOINT copy_files;")
+        for key in keys:
+            load_success(cursor, key, status)
+
+    except Exception as e:
+        cursor.execute("ROLLBACK TO SAVEPOINT copy_files;")
+        if len(keys) == 1:
+            load_fail(cursor, keys[0], e)
+        else:
+            print("batch copy failed, copying one file at a time", e)
+            # files that were read are used up, download them again
+            for key in keys:
+                copy_file(cursor, key, download_or_error(key))
+        for key, f in files:
+            copy_file(cursor, key, f)
+
+    for key, e in failed:
+        load_fail(cursor, key, e)
+
+
+def copy_file(cursor, key, f):
+    copy_files(cursor, ((key, f),))
+
+
 def copy_data(cursor, key):
-    obj = s3.Object(FETCH_BUCKET, key)
     if check_if_done(cursor, key):
         return None
 
-    print(f"Copying data for {key}")
-    with gzip.GzipFile(fileobj=obj.get()["Body"]) as gz:
-        f = io.BufferedReader(gz)
-        iterator = StringIteratorIO(
-            (parse_json(json.loads(line)) for line in f)
-        )
-        try:
-            query = get_query("fetch_copy.sql")
-            cursor.copy_expert(query, iterator)
-            print("status:", cursor.statusmessage)
-            load_success(cursor, key)
+    copy_file(cursor, key, download(key))
+
 
-        except Exception as e:
-            load_fail(cursor, key, e)
+def pending_keys(cursor, keys):
+    return [key for key in keys if not check_if_done(cursor, key)]
 
 
 def process_data(cursor):
@@ -180,9 +418,9 @@ def update_rollups(cursor, mindate, maxdate):
         print("could not get date range, skipping rollup update")
 
 
-@app.command()
-def load_fetch_file(key: str):
-    with psycopg2.connect(settings.DATABASE_WRITE_URL) as connection:
+def load_fetch_file_with(connection, key):
+    """Load a single fetch file in its own transaction on connection."""
+    with connection:
         connection.set_session(autocommit=False)
         with connection.cursor() as cursor:
             create_staging_table(cursor)
@@ -190,9 +428,21 @@ def load_fetch_file(key: str):
             min_date, max_date = filter_data(cursor)
             mindate, maxdate = process_data(cursor)
             update_rollups(cursor, mindate=mindate, maxdate=maxdate)
+            # temp tables outlive the transaction, drop them so the
+            # next file on this connection starts from empty ones
+            cursor.execute("DISCARD TEMP;")
             connection.commit()
 
 
+@app.command()
+def load_fetch_file(key: str):
+    connection = psycopg2.connect(settings.DATABASE_WRITE_URL)
+    try:
+        load_fetch_file_with(connection, key)
+    finally:
+        connection.close()
+
+
 @app.command()
 def load_fetch_day(day: str):
     start = time.time()
@@ -213,8 +463,7 @@ def load_fetch_day(day: str):
         connection.set_session(autocommit=False)
         with connection.cursor() as cursor:
             create_staging_table(cursor)
-            for key in keys:
-                copy_data(cursor, key)
+            copy_files(cursor, prefetch(pending_keys(cursor, keys)))
             print(f"All data copied {time.time()-start}")
             filter_data(cursor)
             mindate, maxdate = process_data(cursor)
@@ -224,9 +473,16 @@ def load_fetch_day(day: str):
 
 def load_prefix(prefix):
     conn = boto3.client("s3")
-    for f in conn.list_objects(Bucket=FETCH_BUCKET, Prefix=prefix)["Contents"]:
-        print(f["Key"])
-        load_fetch_file(f["Key"])
+    # one database connection for every file under the prefix
+    connection = psycopg2.connect(settings.DATABASE_WRITE_URL)
+    try:
+        for f in conn.list_objects(Bucket=FETCH_BUCKET, Prefix=prefix)[
+            "Contents"
+        ]:
+            print(f["Key"])
+            load_fetch_file_with(connection, f["Key"])
+    finally:
+        connection.close()
 
 
 @app.command()
@@ -267,10 +523,9 @@ def load_db(limit: int = 50):
             keys = [r[0] for r in rows]
             if len(keys) > 0:
                 create_staging_table(cursor)
-                for key in keys:
-                    copy_data(cursor, key)
-                    connection.commit()
-                    print("All data copied")
+                copy_files(cursor, prefetch(pending_keys(cursor, keys)))
+                connection.commit()
+                print("All data copied")
                 filter_data(cursor)
                 print('data filtered')
                 process_data(cursor)
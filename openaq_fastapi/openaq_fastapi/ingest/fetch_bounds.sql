@@ -0,0 +1,11 @@
+-- measurements outside of these bounds are removed by fetch_filter.sql
+-- so they do not need to be copied into tempfetchdata
+SELECT
+    (
+        SELECT max(range_end)
+        FROM timescaledb_information.chunks
+        WHERE
+            hypertable_name IN ('rollups', 'measurements')
+            AND is_compressed
+    ),
+    now();
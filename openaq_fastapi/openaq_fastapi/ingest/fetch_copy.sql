@@ -5,12 +5,12 @@ COPY tempfetchdata (
     parameter,
     country,
     city,
-    data,
     source_name,
     datetime,
     coords,
     source_type,
     mobile,
     avpd_unit,
-    avpd_value
-) FROM STDIN;
\ No newline at end of file
+    avpd_value,
+    data_id
+) FROM STDIN WITH (FORMAT binary);
\ No newline at end of file
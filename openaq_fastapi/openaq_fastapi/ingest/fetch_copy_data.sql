@@ -0,0 +1,4 @@
+COPY tempfetchdata_data (
+    data_id,
+    data
+) FROM STDIN WITH (FORMAT binary);
\ No newline at end of file
@@ -1,3 +1,13 @@
+-- row ids are only needed from here on, adding them after the copy
+-- and the filter keeps the identity and its index out of the copy
+ALTER TABLE tempfetchdata
+    ADD COLUMN tfdid int GENERATED ALWAYS AS IDENTITY,
+    ADD COLUMN sensors_id int;
+CREATE INDEX ON tempfetchdata (tfdid);
+
+-- temp tables are never auto analyzed, collect stats after the copy
+ANALYZE tempfetchdata;
+
 CREATE TEMP TABLE IF NOT EXISTS tempfetchdata_sensors AS
 WITH t AS (
 SELECT DISTINCT
@@ -6,7 +16,7 @@ SELECT DISTINCT
     parameter as measurand,
     country,
     city,
-    jsonb_merge_agg(data) as data,
+    array_agg(DISTINCT data_id) as data_ids,
     source_name,
     coords::geometry as geom,
     source_type,
@@ -41,5 +51,15 @@ GROUP BY
     node_metadata,
     sensor_metadata
 )
-SELECT row_number() over () as tfsid, * FROM t;
-CREATE INDEX ON tempfetchdata_sensors (tfsid);
\ No newline at end of file
+SELECT
+    row_number() over () as tfsid,
+    t.*,
+    -- merge the distinct data objects of each sensor
+    COALESCE((
+        SELECT jsonb_object_agg(e.key, e.value)
+        FROM tempfetchdata_data d, jsonb_each(d.data) e
+        WHERE d.data_id = ANY(t.data_ids)
+    ), '{}'::jsonb) as data
+FROM t;
+CREATE INDEX ON tempfetchdata_sensors (tfsid);
+ANALYZE tempfetchdata_sensors;
\ No newline at end of file
@@ -77,3 +77,7 @@ GROUP BY
     1,2,3,4,5,6,7,8,9
 ) as nogeom
 ;
+
+-- index and stats for the spatial node lookup
+CREATE INDEX ON tempfetchdata_nodes USING GIST (geom);
+ANALYZE tempfetchdata_nodes;
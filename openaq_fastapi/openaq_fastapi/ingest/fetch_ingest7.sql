@@ -57,15 +57,30 @@ and tf.units=m.units and tf.measurands_id is null;
 
 -- get cleaned sensors table
 CREATE TEMP TABLE IF NOT EXISTS tempfetchdata_sensors_clean AS
+WITH t AS (
 SELECT
     null::int as sensors_id,
     sensor_nodes_id,
     sensor_systems_id,
     measurands_id,
-    jsonb_merge_agg(sensor_metadata) as metadata,
+    array_agg(DISTINCT sensor_metadata) as metadatas,
     array_merge_agg(tfdids) as tfdids
 FROM tempfetchdata_sensors
-GROUP BY 1,2,3,4;
+GROUP BY 1,2,3,4
+)
+SELECT
+    sensors_id,
+    sensor_nodes_id,
+    sensor_systems_id,
+    measurands_id,
+    -- objects without any keys merge to nothing, keep them as '{}'
+    COALESCE((
+        SELECT jsonb_object_agg(e.key, e.value)
+        FROM unnest(metadatas) m, jsonb_each(m) e
+    ), '{}'::jsonb) as metadata,
+    tfdids
+FROM t;
+ANALYZE tempfetchdata_sensors_clean;
 
 
 -- get sensor id
@@ -5,16 +5,20 @@ CREATE TEMP TABLE IF NOT EXISTS tempfetchdata (
     parameter text,
     country text,
     city text,
-    data jsonb,
+    data_id int,
     source_name text,
     datetime timestamptz,
     coords geography,
     source_type text,
     mobile boolean,
     avpd_unit text,
-    avpd_value float,
-    tfdid int GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
-    sensors_id int
+    avpd_value float
+);
+
+-- each distinct measurement data object, shared by its rows
+CREATE TEMP TABLE IF NOT EXISTS tempfetchdata_data (
+    data_id int PRIMARY KEY,
+    data jsonb
 );
 
 CREATE TEMP TABLE ingestfiles(
@@ -13,6 +13,7 @@ def handler(event, context):
     print(event)
     records = event.get("Records")
     if records is not None:
+        connection = None
         try:
             for record in records:
                 bucket = record["s3"]["bucket"]["name"]
@@ -26,9 +27,11 @@ def handler(event, context):
                 except KeyError:
                     print("could not get last modified time from obj")
                 last_modified = datetime.now().replace(tzinfo=timezone.utc)
-                with psycopg2.connect(
-                    settings.DATABASE_WRITE_URL
-                ) as connection:
+                # one connection for all records, each in its own
+                # transaction
+                if connection is None:
+                    connection = psycopg2.connect(settings.DATABASE_WRITE_URL)
+                with connection:
                     with connection.cursor() as cursor:
                         cursor.execute(
                             """
@@ -47,6 +50,9 @@ def handler(event, context):
                         print(f"{row}")
         except Exception as e:
             print(f"Exception: {e}")
+        finally:
+            if connection is not None:
+                connection.close()
     elif event.get("source") and event["source"] == "aws.events":
         print('running cron job')
         cronhandler(event, context)
@@ -1,8 +1,15 @@
 import io
 import os
+import queue
+import struct
+from datetime import datetime, timezone
+from functools import lru_cache
+from itertools import islice
 from pathlib import Path
+from threading import Event, Thread
 
 import boto3
+from dateutil.parser import parse
 from io import StringIO
 import psycopg2
 import typer
@@ -11,6 +18,8 @@ from ..settings import settings
 
 app = typer.Typer()
 
+UTC = timezone.utc
+
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
 
@@ -27,6 +36,13 @@ class StringIteratorIO(io.TextIOBase):
     def readable(self):
         return True
 
+    def close(self):
+        # let a generator clean up after itself if the reader stops early
+        close = getattr(self._iter, "close", None)
+        if close is not None:
+            close()
+        super().close()
+
     def _read1(self, n=None):
         while not self._buff:
             try:
@@ -55,15 +71,223 @@ class StringIteratorIO(io.TextIOBase):
         return "".join(line)
 
 
+class BytesIteratorIO(io.RawIOBase):
+    """
+    Readable file object over an iterator of bytes chunks, copied
+    straight into the caller's buffer.
+    """
+
+    def __init__(self, iter):
+        self._iter = iter
+        self._buff = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def close(self):
+        # let a generator clean up after itself if the reader stops early
+        close = getattr(self._iter, "close", None)
+        if close is not None:
+            close()
+        super().close()
+
+    def readinto(self, b):
+        while not self._buff:
+            try:
+                self._buff = memoryview(next(self._iter))
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self._buff))
+        b[:n] = self._buff[:n]
+        self._buff = self._buff[n:]
+        return n
+
+
+class _Raised:
+    def __init__(self, error):
+        self.error = error
+
+
+def background(iterable, maxsize=4):
+    """
+    Iterate over iterable in a background thread, handing its items
+    over through a queue of at most maxsize items. Exceptions are
+    raised again in the consuming thread. If the consumer stops early
+    the thread is told to stop as well and is joined, so it does not
+    sit blocked on a full queue holding on to iterable.
+    """
+    items = queue.Queue(maxsize)
+    done = object()
+    stop = Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(_Raised(e))
+            return
+        finally:
+            close = getattr(iterable, "close", None)
+            if close is not None:
+                close()
+        put(done)
+
+    thread = Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if isinstance(item, _Raised):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def join_batches(rows, size):
+    """Join bytes rows into chunks of up to size rows each."""
+    it = iter(rows)
+    while True:
+        batch = b"".join(islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+# fields for COPY ... WITH (FORMAT binary), each is the int32 length of
+# the value followed by the value in the type's binary send format
+COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+COPY_TRAILER = struct.pack(">h", -1)
+NULL = struct.pack(">i", -1)
+PG_EPOCH = datetime(2000, 1, 1, tzinfo=timezone.utc)
+LENGTH = struct.Struct(">i")
+FLOAT8 = struct.Struct(">id")
+INT4 = struct.Struct(">ii")
+INT8 = struct.Struct(">iq")
+BOOL = struct.Struct(">i?")
+# little endian ewkb point with an srid
+EWKB_POINT = struct.Struct("<BIIdd")
+EWKB_POINT_SRID = 0x20000001
+TRUE_STRINGS = frozenset(("t", "true", "y", "yes", "on", "1"))
+
+
+# encoded values of the low cardinality strings (countries, cities,
+# parameters, units...) that repeat on every row, cleared when full
+ENCODED_CACHE_SIZE = 65536
+text_fields = {}
+
+
+def copy_text(value):
+    if value is None or value == "":
+        return NULL
+    if type(value) is str:
+        field = text_fields.get(value)
+        if field is None:
+            if len(text_fields) >= ENCODED_CACHE_SIZE:
+                text_fields.clear()
+            b = value.encode()
+            field = text_fields[value] = LENGTH.pack(len(b)) + b
+        return field
+    b = str(value).encode()
+    return LENGTH.pack(len(b)) + b
+
+
+def copy_int4(value):
+    if value is None:
+        return NULL
+    return INT4.pack(4, value)
+
+
+def copy_float8(value):
+    if value is None or value == "":
+        return NULL
+    return FLOAT8.pack(8, float(value))
+
+
+def copy_bool(value):
+    if value is None or value == "":
+        return NULL
+    if isinstance(value, str):
+        value = value.strip().lower() in TRUE_STRINGS
+    return BOOL.pack(1, bool(value))
+
+
+def copy_jsonb(value):
+    # jsonb is sent as a version byte followed by the json text,
+    # value is the already encoded json
+    return LENGTH.pack(len(value) + 1) + b"\x01" + value
+
+
+def parse_timestamp(value):
+    try:
+        dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        dt = parse(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=UTC)
+    return dt
+
+
+def copy_timestamptz(value):
+    if value is None:
+        return NULL
+    delta = value - PG_EPOCH
+    return INT8.pack(
+        8,
+        (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds,
+    )
+
+
+def copy_point(lon, lat, srid=4326):
+    if lon is None or lat is None:
+        return NULL
+    return LENGTH.pack(EWKB_POINT.size) + EWKB_POINT.pack(
+        1, EWKB_POINT_SRID, srid, float(lon), float(lat)
+    )
+
+
+CSV_ESCAPES = str.maketrans({"\n": "\\n", "\t": " "})
+csv_values = {}
+
+
 def clean_csv_value(value):
     if value is None or value == "":
         return r"\N"
-    return str(value).replace("\n", "\\n").replace("\t", " ")
+    if isinstance(value, (int, float)):
+        # numbers can not contain tabs or newlines
+        return str(value)
+    if type(value) is str:
+        clean = csv_values.get(value)
+        if clean is None:
+            if len(csv_values) >= ENCODED_CACHE_SIZE:
+                csv_values.clear()
+            clean = csv_values[value] = value.translate(CSV_ESCAPES)
+        return clean
+    return str(value).translate(CSV_ESCAPES)
+
+
+@lru_cache(maxsize=32)
+def read_query(file):
+    return Path(os.path.join(dir_path, file)).read_text()
 
 
 def get_query(file, **params):
     # print(f"{params}")
-    query = Path(os.path.join(dir_path, file)).read_text()
+    query = read_query(file)
     if params is not None and len(params) >= 1:
         print(f"adding parameters {params}")
         query = query.format(**params)
@@ -122,7 +346,9 @@ def load_fail(cursor, key, e):
     )
 
 
-def load_success(cursor, key):
+def load_success(cursor, key, message=None):
+    if message is None:
+        message = cursor.statusmessage
     cursor.execute(
         """
         UPDATE fetchlogs
@@ -133,7 +359,7 @@ def load_success(cursor, key):
         key=%s
         """,
         (
-            str(cursor.statusmessage),
+            str(message),
             key,
         ),
     )
@@ -1,19 +1,20 @@
 import logging
-from typing import Any, List
+import os
+from typing import List
 
 from fastapi.exceptions import RequestValidationError
 import orjson
 from fastapi import FastAPI
 from fastapi.openapi.utils import get_openapi
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.middleware.gzip import GZipMiddleware
-from mangum import Mangum
 from pydantic import BaseModel, ValidationError
-from starlette.responses import JSONResponse, RedirectResponse
+from starlette.responses import RedirectResponse, Response
 from fastapi.encoders import jsonable_encoder
 from .middleware import (
     CacheControlMiddleware,
     GetHostMiddleware,
+    GZipMiddleware,
+    PingMiddleware,
     StripParametersMiddleware,
     TotalTimeMiddleware,
 )
@@ -29,16 +30,14 @@ from .routers.cities import router as cities_router
 from .routers.countries import router as countries_router
 from .routers.manufacturers import router as manufacturers_router
 
+from .models.responses import ORJSONResponse
 from .settings import settings
 from .db import db_pool
 
 logger = logging.getLogger("locations")
 logger.setLevel(logging.DEBUG)
 
-
-class ORJSONResponse(JSONResponse):
-    def render(self, content: Any) -> bytes:
-        return orjson.dumps(content)
+PONG = b'{"ping":"pong!"}'
 
 
 app = FastAPI(
@@ -51,14 +50,18 @@ app = FastAPI(
 
 
 def custom_openapi():
-    logger.debug(f"servers -- {app.state.servers}")
-    if app.state.servers is not None and app.openapi_schema:
+    servers = getattr(app.state, "servers", None)
+    logger.debug(f"servers -- {servers}")
+    # only rebuild the schema when we have learned a new server url
+    if app.openapi_schema and (
+        servers is None or servers == app.openapi_schema.get("servers")
+    ):
         return app.openapi_schema
-    logger.debug(f"Creating OpenApi Docs with server {app.state.servers}")
+    logger.debug(f"Creating OpenApi Docs with server {servers}")
     openapi_schema = get_openapi(
         title=app.title,
         description=app.description,
-        servers=app.state.servers,
+        servers=servers,
         version="2.0.0",
         routes=app.routes,
     )
@@ -81,6 +84,7 @@ app.add_middleware(StripParametersMiddleware)
 app.add_middleware(CacheControlMiddleware, cachecontrol="public, max-age=900")
 app.add_middleware(TotalTimeMiddleware)
 app.add_middleware(GetHostMiddleware)
+app.add_middleware(PingMiddleware, path="/ping", body=PONG)
 
 
 class OpenAQValidationResponseDetail(BaseModel):
@@ -122,14 +126,15 @@ async def shutdown_event():
 
 
 @app.get("/ping")
-def pong():
+async def pong():
     """
     Sanity check.
     This will let the user know that the service is operational.
     And this path operation will:
     * show a lifesign
     """
-    return {"ping": "pong!"}
+    # normally answered by PingMiddleware, kept here for the docs
+    return Response(PONG, media_type="application/json")
 
 
 @app.get("/favicon.ico")
@@ -151,15 +156,25 @@ app.include_router(sources_router)
 app.include_router(parameters_router)
 app.include_router(manufacturers_router)
 
-handler = Mangum(app, enable_lifespan=False)
+# only lambda needs the mangum adapter, uvicorn serves the app directly
+if os.getenv("AWS_LAMBDA_FUNCTION_NAME"):
+    from mangum import Mangum
+
+    handler = Mangum(app, enable_lifespan=False)
 
 
 def run():
     try:
         import uvicorn
 
+        # uvloop and httptools are used when installed, see the server extra
         uvicorn.run(
-            "openaq_fastapi.main:app", host="0.0.0.0", port=8888, reload=True
+            "openaq_fastapi.main:app",
+            host="0.0.0.0",
+            port=8888,
+            reload=settings.API_RELOAD,
+            workers=None if settings.API_RELOAD else settings.API_WORKERS,
+            timeout_keep_alive=30,
         )
     except Exception:
         pass
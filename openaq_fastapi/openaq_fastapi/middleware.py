@@ -1,16 +1,25 @@
 import logging
 import re
 import time
+import zlib
 from os import environ
 from typing import Optional
 
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.requests import Request
-from starlette.types import ASGIApp
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 logger = logging.getLogger("locations")
 logger.setLevel(logging.DEBUG)
 
+# array style parameter suffixes, ie country[]=US or country[0]=US
+PARAM_BRACKETS = re.compile(r"\[\d*\]")
+
+# zlib window bits that produce a gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
 
 class CacheControlMiddleware(BaseHTTPMiddleware):
     """MiddleWare to add CacheControl in response headers."""
@@ -57,7 +66,7 @@ class StripParametersMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
         newscope = request.scope
         qs = newscope["query_string"].decode("utf-8")
-        newqs = re.sub(r"\[\d*\]", "", qs).encode("utf-8")
+        newqs = PARAM_BRACKETS.sub("", qs).encode("utf-8")
         newscope["query_string"] = newqs
         new_request = Request(scope=newscope)
 
@@ -84,3 +93,154 @@ class GetHostMiddleware(BaseHTTPMiddleware):
         response = await call_next(request)
 
         return response
+
+
+class PingMiddleware:
+    """MiddleWare to answer health checks before the rest of the stack.
+
+    Added last so it is the outermost middleware, liveness probes get a
+    fixed response without passing through compression, caching and
+    timing or reaching the router.
+    """
+
+    def __init__(
+        self, app: ASGIApp, path: str = "/ping", body: bytes = b""
+    ) -> None:
+        self.app = app
+        self.path = path
+        self.body = body
+        self.headers = [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+        ]
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if (
+            scope["type"] == "http"
+            and scope["path"] == self.path
+            and scope["method"] in ("GET", "HEAD")
+        ):
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 200,
+                    "headers": self.headers,
+                }
+            )
+            await send({"type": "http.response.body", "body": self.body})
+            return
+        await self.app(scope, receive, send)
+
+
+class GZipMiddleware:
+    """MiddleWare to gzip responses for clients that accept it.
+
+    Bodies of at least offload_size bytes are compressed in the
+    threadpool, zlib releases the GIL while it works so large responses
+    do not hold up the event loop.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = 1000,
+        offload_size: int = 64 * 1024,
+        compresslevel: int = 6,
+    ) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.offload_size = offload_size
+        self.compresslevel = compresslevel
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http":
+            headers = Headers(scope=scope)
+            if "gzip" in headers.get("Accept-Encoding", ""):
+                responder = GZipResponder(
+                    self.app,
+                    self.minimum_size,
+                    self.offload_size,
+                    self.compresslevel,
+                )
+                await responder(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+class GZipResponder:
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int,
+        offload_size: int,
+        compresslevel: int,
+    ) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.offload_size = offload_size
+        self.compresslevel = compresslevel
+        self.send: Send = None
+        self.start_message: Message = None
+        self.started = False
+        self.compressor = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        self.send = send
+        await self.app(scope, receive, self.send_gzip)
+
+    async def compress(self, data: bytes) -> bytes:
+        if len(data) >= self.offload_size:
+            return await run_in_threadpool(self.compressor.compress, data)
+        return self.compressor.compress(data)
+
+    async def send_gzip(self, message: Message):
+        message_type = message["type"]
+        if message_type == "http.response.start":
+            # hold the headers until we know whether to compress
+            self.start_message = message
+            return
+        if message_type != "http.response.body":
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if not self.started:
+            self.started = True
+            headers = MutableHeaders(raw=self.start_message["headers"])
+            if "content-encoding" in headers or (
+                not more_body and len(body) < self.minimum_size
+            ):
+                await self.send(self.start_message)
+                await self.send(message)
+                return
+
+            self.compressor = zlib.compressobj(
+                self.compresslevel, zlib.DEFLATED, GZIP_WBITS
+            )
+            headers["Content-Encoding"] = "gzip"
+            headers.add_vary_header("Accept-Encoding")
+            if not more_body:
+                body = await self.compress(body) + self.compressor.flush()
+                headers["Content-Length"] = str(len(body))
+                await self.send(self.start_message)
+                await self.send({"type": "http.response.body", "body": body})
+                return
+            del headers["Content-Length"]
+            await self.send(self.start_message)
+
+        if self.compressor is None:
+            await self.send(message)
+            return
+
+        body = await self.compress(body)
+        if not more_body:
+            body += self.compressor.flush()
+        await self.send(
+            {
+                "type": "http.response.body",
+                "body": body,
+                "more_body": more_body,
+            }
+        )
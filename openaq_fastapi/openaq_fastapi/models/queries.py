@@ -1,13 +1,13 @@
 import inspect
 import logging
-from datetime import date, datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
 from enum import Enum
+from functools import lru_cache
 from types import FunctionType
 from typing import Dict, List, Optional, Union
 
 import humps
 from dateutil.parser import parse
-from dateutil.tz import UTC
 from fastapi import Query
 from pydantic import (
     BaseModel,
@@ -23,6 +23,8 @@ logger.setLevel(logging.DEBUG)
 
 maxint = 2147483647
 
+UTC = timezone.utc
+
 ignore_in_docs = [
     "date_from_adj",
     "date_to_adj",
@@ -32,6 +34,7 @@ ignore_in_docs = [
 ]
 
 
+@lru_cache(maxsize=None)
 def parameter_dependency_from_model(name: str, model_cls):
     """
     Takes a pydantic model class as input and creates
@@ -44,6 +47,9 @@ def parameter_dependency_from_model(name: str, model_cls):
     suitable query parameters. Otherwise fastapi
     will complain down the road.
 
+    The generated function is cached per model so routes sharing
+    a model reuse the same dependency.
+
     Arguments:
         name: Name for the dependency function.
         model_cls: A ``BaseModel`` inheriting model class as input.
@@ -97,7 +103,7 @@ class OBaseModel(BaseModel):
 
     @classmethod
     def depends(cls):
-        logger.debug(f"Depends {cls}")
+        logger.debug("Depends %s", cls)
         return parameter_dependency_from_model("depends", cls)
 
     def params(self):
@@ -217,8 +223,10 @@ class Geo(OBaseModel):
 
     @root_validator(pre=True)
     def addlatlon(cls, values):
+        coords = values.get("coordinates", None)
+        if coords is None:
+            return values
         try:
-            coords = values.get("coordinates", None)
             lat, lon = coords.split(",")
             values["lat"] = lat
             values["lon"] = lon
@@ -227,7 +235,6 @@ class Geo(OBaseModel):
             raise ValueError(f"{e}")
 
     def where_geo(self):
-        self.lat, self.lon = self.coordinates.split(",")
         if self.lat is not None and self.lon is not None:
             return (
                 " st_dwithin(st_makepoint(:lon, :lat)::geography,"
@@ -281,12 +288,20 @@ class Sort(str, Enum):
     desc = "desc"
 
 
+# group types in the rollups that spatial groupings are stored under
+SPATIAL_ROLLUP_TYPES = {"project": "organization", "location": "node"}
+
+
 class Spatial(str, Enum):
     country = "country"
     location = "location"
     project = "project"
     total = "total"
 
+    @property
+    def rollup_type(self):
+        return SPATIAL_ROLLUP_TYPES.get(self.value, self.value)
+
 
 class Temporal(str, Enum):
     day = "day"
@@ -349,3 +364,10 @@ class DateRange(OBaseModel):
     )
     def check_dates(cls, v, values):
         return fix_datetime(v)
+
+    def has_date_range(self):
+        """Whether both dates were given rather than left as defaults."""
+        return (
+            self.date_from != self.__fields__["date_from"].default
+            and self.date_to != self.__fields__["date_to"].default
+        )
@@ -1,9 +1,30 @@
+import os
 from datetime import date, datetime
+from decimal import Decimal
 from typing import List, Optional, Union
 
+import orjson
 from pydantic import AnyUrl
 from pydantic.main import BaseModel
 from pydantic.typing import Any
+from starlette.responses import JSONResponse
+
+
+def orjson_default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, BaseModel):
+        return obj.dict()
+    raise TypeError
+
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        # datetimes are formatted by orjson itself, offsets are left as
+        # they are so utc times keep their +00:00 suffix
+        return orjson.dumps(
+            content, default=orjson_default, option=orjson.OPT_NON_STR_KEYS
+        )
 
 
 class Meta(BaseModel):
@@ -12,7 +33,7 @@ class Meta(BaseModel):
     website: str = "/"
     page: int = 1
     limit: int = 100
-    found: int = 0
+    found: Optional[int] = 0
 
 
 class OpenAQResult(BaseModel):
@@ -20,6 +41,45 @@ class OpenAQResult(BaseModel):
     results: List[Any] = []
 
 
+# name and license never change, only the paging fields are per request
+META_DEFAULTS = Meta().dict()
+
+
+def openaq_meta(found: int = 0, page: int = 1, limit: int = 100) -> dict:
+    meta = META_DEFAULTS.copy()
+    meta["website"] = os.getenv("APP_HOST", "/")
+    meta["page"] = page
+    meta["limit"] = limit
+    meta["found"] = found
+    return meta
+
+
+def openaq_response(
+    results: List[Any] = None, found: int = 0, page: int = 1, limit: int = 100
+) -> ORJSONResponse:
+    """Return an OpenAQResult shaped response.
+
+    Rows come straight from the database so the envelope is built as a
+    plain dict and serialized directly, skipping the validation and
+    jsonable_encoder pass that returning an OpenAQResult goes through.
+    """
+    return ORJSONResponse(
+        {"meta": openaq_meta(found, page, limit), "results": results or []}
+    )
+
+
+def openaq_body(
+    results: bytes, found: int = 0, page: int = 1, limit: int = 100
+) -> bytes:
+    """Return an OpenAQResult shaped body around already encoded results.
+
+    The results array is spliced in as it came from the database, so
+    it is never parsed and serialized again on the way out.
+    """
+    meta = orjson.dumps(openaq_meta(found, page, limit))
+    return b'{"meta":' + meta + b',"results":' + results + b"}"
+
+
 class CoordinatesDict(BaseModel):
     latitude: Optional[float]
     longitude: Optional[float]
@@ -1,6 +1,6 @@
 import logging
+from functools import lru_cache
 
-from dateutil.tz import UTC
 from fastapi import APIRouter, Depends, Query
 from typing import Optional, List
 from ..db import DB
@@ -21,6 +21,98 @@ logger.setLevel(logging.DEBUG)
 
 router = APIRouter()
 
+# rollups holding the rows that are regrouped into other temporal groupings
+ROLLUP_TEMPORAL = {"moy": "month", "dow": "day"}
+
+# column the measurements are grouped by for the hourly groupings
+HOURLY_COLUMNS = {
+    "hour": "date_trunc('hour', datetime)",
+    "hod": "extract('hour' from datetime)",
+}
+
+# label and ordering columns for groupings read from the rollups
+ROLLUP_COLUMNS = {
+    "moy": ("to_char(st, 'Mon')", "to_char(st, 'MM')"),
+    "dow": ("to_char(st, 'Dy')", "to_char(st, 'ID')"),
+}
+
+# hours covered by each row for temporal groupings that span the range
+COUNT_HOURS = {"hour": 1, "day": 24, "month": 24 * 30, "year": 24 * 365}
+
+
+@lru_cache(maxsize=64)
+def bounds_query(where):
+    """
+    CTE clamping the requested dates to the range of the matching rollups
+    and estimating the number of rows. Rows are only produced when the
+    range is not empty, so the query returns nothing when there is no
+    data without a separate round trip to check first.
+    """
+    return f"""
+        totals AS (
+            SELECT
+                min(first_datetime) as range_start,
+                max(last_datetime) as range_end,
+                count(distinct concat(groups_id,'~~~',measurands_id))
+                    as groups
+            FROM rollups
+            LEFT JOIN groups_view USING (groups_id, measurands_id)
+            WHERE
+                rollup = 'total'
+                AND
+                type = :spatial::text
+                AND
+                {where}
+        ),
+        bounds AS (
+            SELECT
+                greatest(:date_from::timestamptz, range_start) as date_from,
+                least(:date_to::timestamptz, range_end) as date_to,
+                floor(CASE WHEN :count_hours::float8 IS NULL THEN groups
+                ELSE groups
+                    * extract(epoch from range_end - range_start) / 3600
+                    / :count_hours::float8
+                END)::bigint as count
+            FROM totals
+            WHERE range_end > range_start
+        )
+        """
+
+
+def filter_kind(values):
+    """Whether a list filter holds ids, names or is unset."""
+    if values is None:
+        return None
+    if all(isinstance(x, int) for x in values):
+        return "id"
+    return "name"
+
+
+@lru_cache(maxsize=128)
+def averages_where(spatial, country, project, location, parameter):
+    """
+    Where clause for an averages request. The clause only depends on
+    which filters are set, not on their values, so it is built once per
+    shape of request. Array parameters are cast so their types are known
+    up front rather than inferred when the statement is prepared.
+    """
+    wheres = []
+    if spatial == "country" and country:
+        wheres.append("name = ANY(:country::text[])")
+    if spatial == "project" and project == "id":
+        wheres.append("groups_id = ANY(:project::int[])")
+    elif spatial == "project" and project == "name":
+        wheres.append("name = ANY(:project::text[])")
+    if spatial == "location" and location:
+        wheres.append("name = ANY(:location::text[])")
+    if parameter == "id":
+        wheres.append(" measurands_id = ANY(:parameter::int[]) ")
+    elif parameter == "name":
+        wheres.append(" measurand = ANY(:parameter::text[]) ")
+    if len(wheres) > 0:
+        return (" AND ").join(wheres)
+    return " TRUE "
+
 
 class Averages(APIBase, Country, Project, Measurands, DateRange):
     spatial: Spatial = Query(...)
@@ -29,27 +121,13 @@ class Averages(APIBase, Country, Project, Measurands, DateRange):
     group: Optional[bool] = False
 
     def where(self):
-        wheres = []
-        if self.spatial == "country" and self.country is not None:
-            wheres.append("name = ANY(:country)")
-        if self.spatial == "project" and self.project is not None:
-            if all(isinstance(x, int) for x in self.project):
-                wheres.append("groups_id = ANY(:project)")
-            else:
-                wheres.append("name = ANY(:project)")
-        if self.spatial == "location" and self.location is not None:
-            wheres.append("name = ANY(:location)")
-        if self.parameter is not None:
-            if all(isinstance(x, int) for x in self.parameter):
-                wheres.append(" measurands_id = ANY(:parameter) ")
-            else:
-                wheres.append(" measurand = ANY(:parameter) ")
-        for f, v in self:
-            if v is not None and f in ["units"]:
-                wheres.append(f"{f} = ANY(:{f})")
-        if len(wheres) > 0:
-            return (" AND ").join(wheres)
-        return " TRUE "
+        return averages_where(
+            self.spatial,
+            self.country is not None,
+            filter_kind(self.project),
+            self.location is not None,
+            filter_kind(self.parameter),
+        )
 
     @root_validator
     def validate_date_range(cls, values):
@@ -67,99 +145,28 @@ class Averages(APIBase, Country, Project, Measurands, DateRange):
         return values
 
 
-@router.get("/v2/averages", response_model=OpenAQResult, tags=["v2"])
-async def averages_v2_get(
-    db: DB = Depends(),
-    av: Averages = Depends(Averages.depends()),
-):
-    date_from = av.date_from
-    date_to = av.date_to
-    initwhere = av.where()
-    qparams = av.dict(exclude_unset=True)
-
-    if qparams["spatial"] == "project":
-        qparams["spatial"] = "organization"
-    elif qparams["spatial"] == "location":
-        qparams["spatial"] = "node"
-
-    q = f"""
-        SELECT
-            min(first_datetime),
-            max(last_datetime),
-            count(distinct concat(groups_id,'~~~',measurands_id)) as groups
-        FROM rollups
-        LEFT JOIN groups_view USING (groups_id, measurands_id)
-        WHERE
-            rollup = 'total'
-            AND
-            type = :spatial::text
-            AND
-            {initwhere}
-        """
-
-    rows = await db.fetch(q, qparams)
-    if rows is None:
-        return OpenAQResult()
-    try:
-        range_start = rows[0][0].replace(tzinfo=UTC)
-        range_end = rows[0][1].replace(tzinfo=UTC)
-        count = rows[0][2]
-    except Exception:
-        return OpenAQResult()
-
-    if date_from is None:
-        qparams["date_from"] = range_start
-    else:
-        qparams["date_from"] = max(date_from, range_start)
-
-    if date_to is None:
-        qparams["date_to"] = range_end
-    else:
-        qparams["date_to"] = min(date_to, range_end)
-
-    if range_end <= range_start:
-        return OpenAQResult()
-
-    temporal = av.temporal
-
-    # estimate max number of rows to be returned
-    hours = (range_end - range_start).total_seconds() / 3600
-    logger.debug(
-        "range_start %s range_end %s hours %s", range_start, range_end, hours
-    )
-    if av.temporal in ["hour"]:
-        count = count * hours
-    elif av.temporal in ["day"]:
-        count = count * hours / 24
-    elif av.temporal in ["month"]:
-        count = count * hours / (24 * 30)
-    elif av.temporal in ["year"]:
-        count = count * hours / (24 * 365)
-    elif av.temporal in ["hod"]:
-        count * 24
-    elif av.temporal in ["dom"]:
-        count * 30
-    else:
-        count = count
-    count = int(count)
-
+@lru_cache(maxsize=128)
+def averages_query(where, temporal, group):
+    """
+    Query for a page of averages, aggregated into a single row. The text
+    only depends on the shape of the request, so it is built once per
+    shape and the driver can reuse its prepared statement. The results
+    come back as utf-8 json bytes that go into the body untouched.
+    """
     wrapper_start = ""
     wrapper_end = ""
     groupby = "1,2,3,4,5,6,7"
-    if av.group:
+    if group:
         wrapper_start = "array_agg(DISTINCT "
         wrapper_end = ")"
         groupby = "1,2,3,4"
 
-    if av.temporal in ["hour", "hod"]:
-        if av.temporal == "hour":
-            temporal_col = "date_trunc('hour', datetime)"
-        else:
-            temporal_col = "extract('hour' from datetime)"
+    if temporal in HOURLY_COLUMNS:
+        temporal_col = HOURLY_COLUMNS[temporal]
         baseq = f"""
             SELECT
                 measurands_id,
-                {temporal_col} as {av.temporal},
+                {temporal_col} as {temporal},
                 {temporal_col} as o,
                 {temporal_col} as st,
                 {wrapper_start}groups_id{wrapper_end} as id,
@@ -171,12 +178,13 @@ async def averages_v2_get(
             LEFT JOIN sensors USING (sensors_id)
             LEFT JOIN groups_sensors USING (sensors_id)
             LEFT JOIN groups_view USING (groups_id, measurands_id)
-            WHERE {initwhere}
+            CROSS JOIN bounds
+            WHERE {where}
             AND
                 type = :spatial::text
             AND datetime
-            BETWEEN :date_from::timestamptz
-            AND :date_to::timestamptz
+            BETWEEN bounds.date_from
+            AND bounds.date_to
             GROUP BY {groupby}
             ORDER BY 4 DESC
             OFFSET :offset
@@ -184,9 +192,10 @@ async def averages_v2_get(
             """
 
     else:
-        temporal_order = "st"
-        temporal_col = "st::date"
-        if av.group or av.temporal in ["dow", "moy"]:
+        temporal_col, temporal_order = ROLLUP_COLUMNS.get(
+            temporal, ("st::date", "st")
+        )
+        if group or temporal in ROLLUP_COLUMNS:
             agg_clause = """
                 sum(value_count) as measurement_count,
                 round((sum(value_sum)/sum(value_count))::numeric, 4) as average
@@ -197,43 +206,34 @@ async def averages_v2_get(
                 round((value_sum/value_count)::numeric, 4) as average
             """
 
-        if av.group:
+        if group:
             group_clause = " GROUP BY 1,2,3 "
         else:
             group_clause = " "
 
-        if av.temporal == "moy":
-            temporal = "month"
-            temporal_order = "to_char(st, 'MM')"
-            temporal_col = "to_char(st, 'Mon')"
-        elif av.temporal == "dow":
-            temporal = "day"
-            temporal_col = "to_char(st, 'Dy')"
-            temporal_order = "to_char(st, 'ID')"
-
-        if av.temporal in ["dow", "moy"]:
-            if av.group:
+        if temporal in ROLLUP_COLUMNS:
+            if group:
                 group_clause = " GROUP BY 1,2,3 "
             else:
                 group_clause = " GROUP BY 1,2,3,4,5,6 "
 
-        where = f"""
+        rollup_where = f"""
             WHERE
                     rollup = :temporal::text
                     AND
                     type = :spatial::text
                     AND
-                    st >= :date_from
+                    st >= bounds.date_from
                     AND
-                    st < :date_to
+                    st < bounds.date_to
                     AND
-                    {initwhere}
+                    {where}
         """
 
         baseq = f"""
             SELECT
                 measurands_id,
-                {temporal_col} as {av.temporal},
+                {temporal_col} as {temporal},
                 {temporal_order} as o,
                 {wrapper_start}groups_id{wrapper_end} as id,
                 {wrapper_start}name{wrapper_end} as name,
@@ -241,27 +241,58 @@ async def averages_v2_get(
                 {agg_clause}
             FROM rollups
             LEFT JOIN groups_view USING (groups_id, measurands_id)
-            {where}
+            CROSS JOIN bounds
+            {rollup_where}
             {group_clause}
             ORDER BY 3 DESC
             OFFSET :offset
             LIMIT :limit
         """
 
-    qparams["count"] = count
-
-    q = f"""
-        WITH base AS (
+    return f"""
+        WITH {bounds_query(where)},
+        base AS (
             {baseq}
         )
-        SELECT :count::bigint as count,
-        (to_jsonb(base) ||
-        parameter(measurands_id)) -
-        '{{o,st, measurands_id}}'::text[]
+        SELECT (SELECT count FROM bounds) as count,
+        convert_to(COALESCE(jsonb_agg(
+            (to_jsonb(base) || parameter(measurands_id))
+            - '{{o,st, measurands_id}}'::text[]
+            ORDER BY o DESC
+        ), '[]'::jsonb)::text, 'UTF8') as results
         FROM base
         """
-    av.temporal = temporal
-    qparams["temporal"] = temporal
-    output = await db.fetchOpenAQResult(q, qparams)
 
-    return output
+
+@router.get("/v2/averages", response_model=OpenAQResult, tags=["v2"])
+async def averages_v2_get(
+    db: DB = Depends(),
+    av: Averages = Depends(Averages.depends()),
+):
+    date_from = av.date_from
+    date_to = av.date_to
+    initwhere = av.where()
+    # every field is set by the dependency and none are nested models, a
+    # copy of the validated values is all that dict() would return
+    qparams = av.__dict__.copy()
+
+    qparams["spatial"] = av.spatial.rollup_type
+
+    # name filters are bound as text[], ids mixed in with names are names
+    for f in ("project", "parameter"):
+        if filter_kind(qparams.get(f)) == "name":
+            qparams[f] = [str(v) for v in qparams[f]]
+
+    qparams["date_from"] = date_from
+    qparams["date_to"] = date_to
+    # hours per row returned, used to estimate how many rows there are
+    qparams["count_hours"] = COUNT_HOURS.get(av.temporal)
+
+    temporal = av.temporal.value
+    # day of week and month of year are read from the day and month rollups
+    qparams["temporal"] = ROLLUP_TEMPORAL.get(temporal, temporal)
+    q = averages_query(initwhere, temporal, av.group)
+
+    # rows are built by the database, return them without revalidating
+    # against the response model which is kept for the docs
+    return await db.fetchOpenAQResponse(q, qparams)
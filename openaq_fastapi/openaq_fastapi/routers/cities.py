@@ -25,20 +25,18 @@ class Cities(City, Country, APIBase):
 
     def where(self):
         wheres = []
-        for f, v in self:
-            if v is not None:
-                if f == "city":
-                    wheres.append(
-                        """
-                        city = ANY(:city)
-                        """
-                    )
-                elif f == "country":
-                    wheres.append(
-                        """
-                        country = ANY(:country)
-                        """
-                    )
+        if self.city is not None:
+            wheres.append(
+                """
+                city = ANY(:city)
+                """
+            )
+        if self.country is not None:
+            wheres.append(
+                """
+                country = ANY(:country)
+                """
+            )
         if len(wheres) > 0:
             return (" AND ").join(wheres)
         return " TRUE "
@@ -27,13 +27,8 @@ class Countries(Country, APIBase):
     order_by: CountriesOrder = Query("country")
 
     def where(self):
-        wheres = []
-        for f, v in self:
-            if v is not None:
-                if f == "country":
-                    wheres.append(" cl.iso = ANY(:country) ")
-        if len(wheres) > 0:
-            return (" AND ").join(wheres)
+        if self.country is not None:
+            return " cl.iso = ANY(:country) "
         return " TRUE "
 
 
@@ -1,8 +1,10 @@
 import logging
+from functools import lru_cache
 from typing import List
 
 import jq
 from fastapi import APIRouter, Depends, Query
+from starlette.responses import Response
 from pydantic.typing import Optional
 from enum import Enum
 from ..db import DB
@@ -21,6 +23,8 @@ from ..models.queries import (
 
 from openaq_fastapi.models.responses import (
     OpenAQResult,
+    openaq_meta,
+    openaq_response,
 )
 
 logger = logging.getLogger("locations")
@@ -28,6 +32,54 @@ logger.setLevel(logging.DEBUG)
 
 router = APIRouter()
 
+# compiled once, reused for every request
+LATEST_JQ = jq.compile(
+    """
+    .[] |
+        {
+            location: .name,
+            city: .city,
+            country: .country,
+            coordinates: .coordinates,
+            measurements: [
+                .parameters[] | {
+                    parameter: .measurand,
+                    value: .lastValue,
+                    lastUpdated: .lastUpdated,
+                    unit: .unit
+                }
+            ]
+        }
+
+    """
+)
+
+LOCATIONS_V1_JQ = jq.compile(
+    """
+    .[] |
+        {
+            id: .id,
+            country: .country,
+            city: .city,
+            location: .name,
+            soureName: .source_name,
+            sourceType: .sources[0].name,
+            coordinates: .coordinates,
+            firstUpdated: .firstUpdated,
+            lastUpdated: .lastUpdated,
+            parameters : [ .parameters[].parameter ],
+            countsByMeasurement: [
+                .parameters[] | {
+                    parameter: .parameter,
+                    count: .count
+                }
+            ],
+            count: .parameters| map(.count) | add
+        }
+
+    """
+)
+
 
 class LocationsOrder(str, Enum):
     city = "city"
@@ -40,6 +92,64 @@ class LocationsOrder(str, Enum):
     random = "random"
 
 
+def ids_or_names(ids, names):
+    """Where builder for a filter that holds either ids or names."""
+
+    def where(v):
+        if all(isinstance(x, int) for x in v):
+            return ids
+        return names
+
+    return where
+
+
+# sql for each filter that is used when the field is set
+WHERE_BUILDERS = {
+    "parameter": ids_or_names(
+        """
+        parameters @> ANY(
+            jsonb_array_query('parameterId',:parameter::int[])
+            )
+        """,
+        """
+        parameters @> ANY(
+            jsonb_array_query('parameter',:parameter::text[])
+            )
+        """,
+    ),
+    "unit": lambda v: """
+        parameters @> ANY(
+            jsonb_array_query('unit',:unit::text[])
+            )
+        """,
+    "country": lambda v: " country = ANY(:country) ",
+    "city": lambda v: " city = ANY(:city) ",
+    "location": ids_or_names(
+        " id = ANY(:location) ", " name = ANY(:location) "
+    ),
+    "isMobile": lambda v: f' "isMobile" = {bool(v)} ',
+    "sourceName": lambda v: """
+        sources @> ANY(
+            jsonb_array_query('name',:source_name::text[])
+            ||
+            jsonb_array_query('id',:source_name::text[])
+            )
+        """,
+    "entity": lambda v: " entity = ANY(:entity) ",
+    "sensorType": lambda v: ' "sensorType" = ANY(:sensor_type) ',
+    "modelName": lambda v: """
+        manufacturers @> ANY(
+            jsonb_array_query('modelName',:model_name::text[])
+            )
+        """,
+    "manufacturerName": lambda v: """
+        manufacturers @> ANY(
+            jsonb_array_query('manufacturerName',:manufacturer_name::text[])
+            )
+        """,
+}
+
+
 class Locations(Location, City, Country, Geo, Measurands, HasGeo, APIBase):
     order_by: LocationsOrder = Query(
         "lastUpdated", description="Order by a field"
@@ -64,88 +174,10 @@ class Locations(Location, City, Country, Geo, Measurands, HasGeo, APIBase):
 
     def where(self):
         wheres = []
-
-        for f, v in self:
+        for f, where in WHERE_BUILDERS.items():
+            v = getattr(self, f)
             if v is not None:
-                if f == "project":
-                    if all(isinstance(x, int) for x in self.project):
-                        wheres.append("groups_id = ANY(:project)")
-                    else:
-                        wheres.append("name = ANY(:project)")
-                elif f == "location":
-                    if all(isinstance(x, int) for x in v):
-                        wheres.append(" id = ANY(:location) ")
-                    else:
-                        wheres.append(" name = ANY(:location) ")
-                elif f == "country":
-                    wheres.append(" country = ANY(:country) ")
-                elif f == "city":
-                    wheres.append(" city = ANY(:city) ")
-                elif f == "parameter":
-                    if all(isinstance(x, int) for x in v):
-                        wheres.append(
-                            """
-                            parameters @> ANY(
-                                jsonb_array_query('parameterId',:parameter::int[])
-                                )
-                            """
-                        )
-                    else:
-                        wheres.append(
-                            """
-                            parameters @> ANY(
-                                jsonb_array_query('parameter',:parameter::text[])
-                                )
-                            """
-                        )
-                elif f == "sourceName":
-                    wheres.append(
-                        """
-                        sources @> ANY(
-                            jsonb_array_query('name',:source_name::text[])
-                            ||
-                            jsonb_array_query('id',:source_name::text[])
-                            )
-                        """
-                    )
-                elif f == "entity":
-                    wheres.append(
-                        """
-                        entity = ANY(:entity)
-                        """
-                    )
-                elif f == "sensorType":
-                    wheres.append(
-                        """
-                        "sensorType" = ANY(:sensor_type)
-                        """
-                    )
-                elif f == "modelName":
-                    wheres.append(
-                        """
-                        manufacturers @> ANY(
-                            jsonb_array_query('modelName',:model_name::text[])
-                            )
-                        """
-                    )
-                elif f == "manufacturerName":
-                    wheres.append(
-                        """
-                        manufacturers @> ANY(
-                            jsonb_array_query('manufacturerName',:manufacturer_name::text[])
-                            )
-                        """
-                    )
-                elif f == "isMobile":
-                    wheres.append(f' "isMobile" = {bool(v)} ')
-                elif f == "unit":
-                    wheres.append(
-                        """
-                            parameters @> ANY(
-                                jsonb_array_query('unit',:unit::text[])
-                                )
-                            """
-                    )
+                wheres.append(where(v))
         wheres.append(self.where_geo())
         wheres = [w for w in wheres if w is not None]
         if len(wheres) > 0:
@@ -153,40 +185,65 @@ class Locations(Location, City, Country, Geo, Measurands, HasGeo, APIBase):
         return " TRUE "
 
 
-@router.get(
-    "/v2/locations/{location_id}", response_model=OpenAQResult, tags=["v2"]
-)
-@router.get("/v2/locations", response_model=OpenAQResult, tags=["v2"])
-async def locations_get(
-    db: DB = Depends(),
-    locations: Locations = Depends(Locations.depends()),
-):
+# final selects over the page of rows (t2) and the total found (nodes)
+ROWS_SELECT = """
+        SELECT nodes as count, jsonb_agg(json ORDER BY row)::text as json
+        FROM t2, nodes
+        GROUP BY nodes
+"""
+
+# the whole response body, json rather than jsonb keeps the key order and
+# bytea hands it back as utf-8 bytes rather than decoding to a str
+ENVELOPE_SELECT = """
+        SELECT convert_to(json_build_object(
+            'meta', json_build_object(
+                'name', :name::text,
+                'license', :license::text,
+                'website', :website::text,
+                'page', :page::int,
+                'limit', :limit::int,
+                'found', COALESCE(max(nodes), 0)
+            ),
+            'results', COALESCE(jsonb_agg(json ORDER BY row), '[]'::jsonb)
+        )::text, 'UTF8')
+        FROM t2, nodes
+"""
 
-    order_by = locations.order_by
+
+@lru_cache(maxsize=128)
+def locations_query(where, order_by, sort, select):
+    """
+    Query for a page of locations. The text only depends on the shape
+    of the request so it is built once per shape.
+    """
     if order_by == "location":
         order_by = "name"
     elif order_by == "count":
         order_by = "measurements"
 
     if order_by == "random":
-        order_by = " random() "
+        # random() is never null, ordering by it needs no null handling
+        order_by = f" random() {sort} "
         lastupdateq = """
             AND "lastUpdated" > now() - '2 weeks'::interval
             """
+    elif sort == "asc":
+        # nulls already sort last ascending, leaving it implicit keeps
+        # the ordering the same as a plain index on the column
+        order_by = f'"{order_by}" {sort}'
+        lastupdateq = ""
     else:
-        order_by = f'"{order_by}"'
+        order_by = f'"{order_by}" {sort} nulls last'
         lastupdateq = ""
 
-    qparams = locations.params()
-
-    q = f"""
+    return f"""
         WITH t1 AS (
             SELECT *, row_number() over () as row
             FROM locations_base_v2
             WHERE
-            {locations.where()}
+            {where}
             {lastupdateq}
-            ORDER BY {order_by} {locations.sort} nulls last
+            ORDER BY {order_by}
             LIMIT :limit
             OFFSET :offset
         ),
@@ -194,7 +251,7 @@ async def locations_get(
             SELECT count(distinct id) as nodes
             FROM locations_base_v2
             WHERE
-            {locations.where()}
+            {where}
             {lastupdateq}
         ),
         t2 AS (
@@ -205,18 +262,46 @@ async def locations_get(
         ) as json
         FROM t1 group by row, t1, json
         )
-        SELECT nodes as count, json
-        FROM t2, nodes
-        ORDER BY row
-
+        {select}
         ;
         """
 
+
+async def locations_fetch(
+    db: DB, locations: Locations, select: str, **extra
+):
+    qparams = locations.params()
+    qparams.update(extra)
+    q = locations_query(
+        locations.where(), locations.order_by, locations.sort, select
+    )
+
     logger.debug(f"**** {qparams}")
 
-    output = await db.fetchOpenAQResult(q, qparams)
+    # every select aggregates the page into a single row
+    return await db.fetchrow(q, qparams)
 
-    return output
+
+async def locations_rows(db: DB, locations: Locations):
+    """Return the locations found and the page of rows as a JSON array."""
+    row = await locations_fetch(db, locations, ROWS_SELECT)
+    if row is None:
+        return 0, "[]"
+    return row[0], row[1]
+
+
+@router.get(
+    "/v2/locations/{location_id}", response_model=OpenAQResult, tags=["v2"]
+)
+@router.get("/v2/locations", response_model=OpenAQResult, tags=["v2"])
+async def locations_get(
+    db: DB = Depends(),
+    locations: Locations = Depends(Locations.depends()),
+):
+    # the database builds the whole body, it is passed through untouched
+    meta = openaq_meta(page=locations.page, limit=locations.limit)
+    body = await locations_fetch(db, locations, ENVELOPE_SELECT, **meta)
+    return Response(body[0], media_type="application/json")
 
 
 @router.get(
@@ -231,36 +316,12 @@ async def latest_get(
     db: DB = Depends(),
     locations: Locations = Depends(Locations.depends()),
 ):
-    data = await locations_get(db, locations)
-    meta = data.meta
-    res = data.results
-    if len(res) == 0:
-        return data
-
-    latest_jq = jq.compile(
-        """
-        .[] |
-            {
-                location: .name,
-                city: .city,
-                country: .country,
-                coordinates: .coordinates,
-                measurements: [
-                    .parameters[] | {
-                        parameter: .measurand,
-                        value: .lastValue,
-                        lastUpdated: .lastUpdated,
-                        unit: .unit
-                    }
-                ]
-            }
-
-        """
+    found, results = await locations_rows(db, locations)
+    ret = LATEST_JQ.input(text=results).all()
+    return openaq_response(
+        ret, found=found, page=locations.page, limit=locations.limit
     )
 
-    ret = latest_jq.input(res).all()
-    return OpenAQResult(meta=meta, results=ret)
-
 
 @router.get(
     "/v1/locations/{location_id}", response_model=OpenAQResult, tags=["v1"]
@@ -270,35 +331,8 @@ async def locationsv1_get(
     db: DB = Depends(),
     locations: Locations = Depends(Locations.depends()),
 ):
-    data = await locations_get(db, locations)
-    meta = data.meta
-    res = data.results
-
-    latest_jq = jq.compile(
-        """
-        .[] |
-            {
-                id: .id,
-                country: .country,
-                city: .city,
-                location: .name,
-                soureName: .source_name,
-                sourceType: .sources[0].name,
-                coordinates: .coordinates,
-                firstUpdated: .firstUpdated,
-                lastUpdated: .lastUpdated,
-                parameters : [ .parameters[].parameter ],
-                countsByMeasurement: [
-                    .parameters[] | {
-                        parameter: .parameter,
-                        count: .count
-                    }
-                ],
-                count: .parameters| map(.count) | add
-            }
-
-        """
+    found, results = await locations_rows(db, locations)
+    ret = LOCATIONS_V1_JQ.input(text=results).all()
+    return openaq_response(
+        ret, found=found, page=locations.page, limit=locations.limit
     )
-
-    ret = latest_jq.input(res).all()
-    return OpenAQResult(meta=meta, results=ret)
@@ -21,12 +21,13 @@ async def mfr_get(db: DB = Depends()):
     select distinct metadata->>'manufacturer_name' as vals from sensor_systems
     where metadata ? 'manufacturer_name'
     )
-    SELECT count(*) OVER () as count, to_jsonb(vals) as json FROM t
+    SELECT count(*) as count,
+        convert_to(COALESCE(jsonb_agg(vals), '[]'::jsonb)::text, 'UTF8')
+        as results
+    FROM t
     """
 
-    output = await db.fetchOpenAQResult(q, {"page": 1, "limit": 1000})
-
-    return output
+    return await db.fetchOpenAQResponse(q, {"page": 1, "limit": 1000})
 
 
 @router.get("/v2/models", response_model=OpenAQResult, tags=["v2"])
@@ -37,9 +38,10 @@ async def model_get(db: DB = Depends()):
     select distinct metadata->>'model_name' as vals from sensor_systems
     where metadata ?'model_name'
     )
-    SELECT count(*) OVER () as count, to_jsonb(vals) as json FROM t
+    SELECT count(*) as count,
+        convert_to(COALESCE(jsonb_agg(vals), '[]'::jsonb)::text, 'UTF8')
+        as results
+    FROM t
     """
 
-    output = await db.fetchOpenAQResult(q, {"page": 1, "limit": 1000})
-
-    return output
+    return await db.fetchOpenAQResponse(q, {"page": 1, "limit": 1000})
@@ -1,15 +1,13 @@
 from enum import Enum
+from functools import lru_cache
 import logging
-import os
 from typing import Optional
 
-import orjson as json
-from dateutil.tz import UTC
-from datetime import timedelta, datetime
+from datetime import timedelta, datetime, timezone
+import orjson
 from fastapi import APIRouter, Depends, Query
 from starlette.responses import Response
 from ..db import DB
-from ..models.responses import Meta
 from ..models.queries import (
     APIBase,
     City,
@@ -21,11 +19,9 @@ from ..models.queries import (
     Measurands,
     Sort,
 )
-import csv
-import io
-
 from openaq_fastapi.models.responses import (
-    OpenAQResult,
+    openaq_body,
+    openaq_response,
 )
 
 logger = logging.getLogger("locations")
@@ -33,8 +29,37 @@ logger.setLevel(logging.DEBUG)
 
 router = APIRouter()
 
+UTC = timezone.utc
+
+# size of the date windows a page of measurements is filled from
+WINDOW = timedelta(days=1)
+
+# longest explicit date range paged through without the summary query
+MAX_UNCOUNTED_RANGE = timedelta(days=31)
+
+# request fields bound into the measurements queries
+QUERY_PARAMS = (
+    "location",
+    "measurand",
+    "unit",
+    "country",
+    "city",
+    "lat",
+    "lon",
+    "radius",
+    "offset",
+    "limit",
+    "project",
+    "date_from",
+    "date_to",
+)
+
 
 def meas_csv(rows):
+    # only needed for csv downloads, keep it off the import path
+    import csv
+    import io
+
     output = io.StringIO()
     writer = csv.writer(output)
     header = [
@@ -71,6 +96,154 @@ def meas_csv(rows):
     return output.getvalue()
 
 
+def date_windows(date_from, date_to, delta, sort):
+    """
+    Step through the date range in windows of size delta,
+    starting from the end the results are sorted from.
+    """
+    if sort == "asc":
+        rangestart = date_from
+        rangeend = min(date_from + delta, date_to)
+    else:
+        rangeend = date_to
+        rangestart = max(date_to - delta, date_from)
+    while rangestart >= date_from and rangeend <= date_to:
+        yield rangestart, rangeend
+        if sort == "desc":
+            rangestart -= delta
+            rangeend -= delta
+        else:
+            rangestart += delta
+            rangeend += delta
+
+
+@lru_cache(maxsize=64)
+def summary_query(joins, where):
+    """
+    Query for the count and date range of the matching measurements,
+    with the requested dates clamped to the range of the data.
+    The text only depends on the shape of the request so it can be
+    cached here and as a prepared statement by the driver.
+    """
+    return f"""
+        SELECT
+            sum(value_count),
+            greatest(:date_from::timestamptz, min(first_datetime)),
+            least(
+                max(last_datetime),
+                CASE WHEN :date_to::timestamptz IS NOT NULL
+                THEN least(:date_to::timestamptz, now()) END
+            )
+        FROM rollups
+        LEFT JOIN groups_view USING (groups_id, measurands_id)
+        {joins}
+        WHERE rollup = 'month' and type=:rolluptype::text
+            AND
+            st >= :date_from::timestamptz
+            AND
+            st < :date_to::timestamptz
+            AND
+            {where}
+        """
+
+
+@lru_cache(maxsize=64)
+def page_query(where, order_by, sort):
+    """
+    Query for a page of measurements, filled from date windows in order.
+    Each window is sorted and limited on its own, the outer limit stops
+    the scan as soon as enough windows have been read to fill the page.
+    json rather than jsonb keeps the keys in the order they are listed,
+    the page comes back as utf-8 json bytes for the response body.
+    """
+    return f"""
+    SELECT
+        :count::bigint as count,
+        convert_to(COALESCE(json_agg(
+            json_build_object(
+                'locationId', location_id,
+                'location', location,
+                'parameter', parameter,
+                'value', value,
+                'date', json_build_object(
+                    'utc',
+                    format_timestamp(datetime, 'UTC'),
+                    'local',
+                    format_timestamp(datetime, timezone)
+                ),
+                'unit', unit,
+                'coordinates',
+                CASE WHEN lon is not null and lat is not null THEN
+                    json_build_object(
+                        'latitude', lat,
+                        'longitude', lon
+                        )
+                    WHEN geog is not null THEN
+                    json_build_object(
+                            'latitude', st_y(geog::geometry),
+                            'longitude', st_x(geog::geometry)
+                        )
+                    ELSE NULL END,
+                'country', country,
+                'city', city,
+                'isMobile', ismobile
+            )
+            ORDER BY n, "{order_by}" {sort}
+        ), '[]'::json)::text, 'UTF8') as rows
+    FROM (
+        SELECT w.n, m.*
+        FROM unnest(
+            :rangestarts::timestamptz[],
+            :rangeends::timestamptz[]
+        ) WITH ORDINALITY AS w(rangestart, rangeend, n)
+        CROSS JOIN LATERAL (
+            SELECT
+                sensor_nodes_id as location_id,
+                site_name as location,
+                measurand as parameter,
+                value,
+                datetime,
+                timezone,
+                lon,
+                lat,
+                b.geog,
+                units as unit,
+                country,
+                city,
+                ismobile
+            FROM measurements a
+            LEFT JOIN measurements_fastapi_base b USING (sensors_id)
+            WHERE {where}
+            AND datetime >= w.rangestart
+            AND datetime <= w.rangeend
+            ORDER BY "{order_by}" {sort}
+            OFFSET :offset
+            LIMIT :limit
+        ) m
+        -- windows in order, so the page is the same on every run
+        ORDER BY w.n, m."{order_by}" {sort}
+        LIMIT :limit
+    ) t;
+    """
+
+
+def location_where(v):
+    if all(isinstance(x, int) for x in v):
+        return " sensor_nodes_id = ANY(:location) "
+    return " site_name = ANY(:location) "
+
+
+# sql for each filter that is used when the field is set
+WHERE_BUILDERS = {
+    "location": location_where,
+    "parameter": lambda v: " measurand = ANY(:measurand) ",
+    "unit": lambda v: " units = ANY(:unit) ",
+    "isMobile": lambda v: " ismobile = :mobile ",
+    "country": lambda v: "country = ANY(:country)",
+    "city": lambda v: "city = ANY(:city)",
+}
+
+
 class MeasOrder(str, Enum):
     city = "city"
     country = "country"
@@ -85,6 +258,15 @@ class Measurements(
     sort: Sort = "desc"
     isMobile: bool = None
     project: Optional[int] = None
+    include_count: bool = Query(
+        True,
+        description="""
+        Count the matching measurements (meta.found). Set to false to
+        skip the count on pages of up to 100 results with both
+        date_from and date_to set, no more than 31 days apart;
+        meta.found is null for those pages.
+        """,
+    )
 
     def where(self):
         wheres = []
@@ -93,25 +275,14 @@ class Measurements(
                 " st_dwithin(st_makepoint(:lon, :lat)::geography,"
                 " b.geog, :radius) "
             )
-        for f, v in self:
+        for f, where in WHERE_BUILDERS.items():
+            v = getattr(self, f)
             if v is not None:
-                if f == "location" and all(isinstance(x, int) for x in v):
-                    wheres.append(" sensor_nodes_id = ANY(:location) ")
-                elif f == "location":
-                    wheres.append(" site_name = ANY(:location) ")
-                elif f == "parameter":
-                    wheres.append(" measurand = ANY(:measurand) ")
-                elif f == "unit":
-                    wheres.append(" units = ANY(:unit) ")
-                elif f == "isMobile":
-                    wheres.append(" ismobile = :mobile ")
-                elif f in ["country", "city"]:
-                    wheres.append(f"{f} = ANY(:{f})")
-        wheres.append(self.where_geo())
-        wheres = list(filter(None, wheres))
-        if len(wheres) > 0:
-            return (" AND ").join(wheres)
-        return " TRUE "
+                wheres.append(where(v))
+        geo = self.where_geo()
+        if geo is not None:
+            wheres.append(geo)
+        return " AND ".join(wheres) if wheres else "TRUE"
 
 
 @router.get("/v1/measurements", tags=["v1"])
@@ -124,86 +295,66 @@ async def measurements_get(
     count = None
     date_from = m.date_from
     date_to = m.date_to
-    where = m.where()
-    params = m.params()
-
-    rolluptype = "node"
+    # the summary query may narrow or swap out where, the measurement
+    # windows always use the filters from the request
+    base_where = m.where()
+    where = base_where
+    params = {f: getattr(m, f) for f in QUERY_PARAMS}
 
-    if m.project is not None:
-        locations = await db.fetchval(
-            """
-            SELECT nodes_from_project(:project::int);
-            """,
-            params,
-        )
-        params["locations"] = locations
-        where = f"{where} AND sensor_nodes_id = ANY(:locations) "
-
-    joins = """
-        LEFT JOIN groups_sensors USING (groups_id)
-        LEFT JOIN measurements_fastapi_base b
-        ON (groups_sensors.sensors_id=b.sensors_id)
-    """
     params["mobile"] = m.isMobile
-    if m.isMobile is None:
-        if (
-            (m.location is None or len(m.location) == 0)
-            and m.isMobile is None
-            and m.coordinates is None
-            and m.project is None
-        ):
-            joins = ""
-            if m.country is None or len(m.country) == 0:
-                rolluptype = "total"
-            else:
-                rolluptype = "country"
-                params["country"] = m.country
-                where = " name =ANY(:country) "
-    # get overall summary numbers
-    q = f"""
-        SELECT
-            sum(value_count),
-            min(first_datetime),
-            max(last_datetime)
-        FROM rollups
-        LEFT JOIN groups_view USING (groups_id, measurands_id)
-        {joins}
-        WHERE rollup = 'month' and type='{rolluptype}'
-            AND
-            st >= :date_from::timestamptz
-            AND
-            st < :date_to::timestamptz
-            AND
-            {where}
-        """
-    logger.debug(f"Params: {params}")
-    rows = await db.fetch(q, params)
-    logger.debug(f"{rows}")
-    if rows is None:
-        return OpenAQResult()
-    try:
-        total_count = rows[0][0]
-        range_start = rows[0][1].replace(tzinfo=UTC)
-        range_end = rows[0][2].replace(tzinfo=UTC)
-    except Exception:
-        return OpenAQResult()
-
-    if date_from is None:
-        date_from = range_start
-    else:
-        date_from = max(date_from, range_start)
 
-    if date_to is None:
-        date_to = range_end
+    # a short page over an explicit date range can be paged through
+    # without the summary query when the count is turned off
+    skip_summary = (
+        not m.include_count
+        and m.limit <= 100
+        and m.has_date_range()
+        and date_to - date_from <= MAX_UNCOUNTED_RANGE
+    )
+    if skip_summary:
+        date_to = min(date_to, datetime.now(UTC))
     else:
-        date_to = min(
-            date_to, range_end, datetime.utcnow().replace(tzinfo=UTC)
-        )
-
-    count = total_count
-    # if time is unbounded, we can just use the total count
-    if (date_from == range_start) and (date_to == range_end):
-        count = total_count
+        rolluptype = "node"
+
+        if m.project is not None:
+            # looked up by the summary query itself rather than in a
+            # round trip of its own, the subquery is only run once
+            where = f"""{where} AND sensor_nodes_id = ANY(
+                (SELECT nodes_from_project(:project::int))
+            ) """
+
+        joins = """
+            LEFT JOIN groups_sensors USING (groups_id)
+            LEFT JOIN measurements_fastapi_base b
+            ON (groups_sensors.sensors_id=b.sensors_id)
+        """
+        if m.isMobile is None:
+            if (
+                (m.location is None or len(m.location) == 0)
+                and m.isMobile is None
+                and m.coordinates is None
+                and m.project is None
+            ):
+                joins = ""
+                if m.country is None or len(m.country) == 0:
+                    rolluptype = "total"
+                else:
+                    rolluptype = "country"
+                    params["country"] = m.country
+                    where = " name =ANY(:country) "
+        # get overall summary numbers
+        q = summary_query(joins, where)
+        params["rolluptype"] = rolluptype
+        logger.debug("Params: %s", params)
+        row = await db.fetchrow(q, params)
+        logger.debug("%s", row)
+        if row is None:
+            return openaq_response(page=m.page, limit=m.limit)
+        # asyncpg hands back timestamptz values as aware utc datetimes
+        total_count, date_from, date_to = row
+        if date_from is None or date_to is None:
+            return openaq_response(page=m.page, limit=m.limit)
+        count = int(total_count)
 
     date_from_adj = date_from
     date_to_adj = date_to
@@ -211,138 +362,43 @@ async def measurements_get(
     params["date_from_adj"] = date_from_adj
     params["date_to_adj"] = date_to_adj
 
-    days = (date_to_adj - date_from_adj).total_seconds() / (24 * 60 * 60)
-    logger.debug(f" days {days}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(" days %s", (date_to_adj - date_from_adj).days)
 
     # if we are ordering by time, keep us from searching everything
     # for paging
-    delta = timedelta(days=1)
     if m.order_by == "datetime":
         if m.sort == "asc":
-            date_to_adj = date_from_adj + delta
+            date_to_adj = date_from_adj + WINDOW
         else:
-            date_from_adj = date_to_adj - delta
+            date_from_adj = date_to_adj - WINDOW
 
     params["date_from_adj"] = date_from_adj
     params["date_to_adj"] = date_to_adj
 
     # count = total_count
-    results = []
-    if count > 0:
-        if m.sort == "asc":
-            rangestart = date_from
-            rangeend = min(date_from + delta, date_to)
-        else:
-            rangeend = date_to
-            rangestart = max(date_to - delta, date_from)
-
-        logger.debug(f"Entering loop {count} {rangestart} {rangeend}")
-        rc = 0
-        params["rangestart"] = rangestart
-        params["rangeend"] = rangeend
-        while rc < m.limit and rangestart >= date_from and rangeend <= date_to:
-            logger.debug(f"looping... {rc} {rangestart} {rangeend}")
-            q = f"""
-            WITH t AS (
-                SELECT
-                    sensor_nodes_id as location_id,
-                    site_name as location,
-                    measurand as parameter,
-                    value,
-                    datetime,
-                    timezone,
-                    CASE WHEN lon is not null and lat is not null THEN
-                        json_build_object(
-                            'latitude',lat,
-                            'longitude', lon
-                            )
-                        WHEN b.geog is not null THEN
-                        json_build_object(
-                                'latitude', st_y(geog::geometry),
-                                'longitude', st_x(geog::geometry)
-                            )
-                        ELSE NULL END AS coordinates,
-                    units as unit,
-                    country,
-                    city,
-                    ismobile
-                FROM measurements a
-                LEFT JOIN measurements_fastapi_base b USING (sensors_id)
-                WHERE {m.where()}
-                AND datetime >= :rangestart::timestamptz
-                AND datetime <= :rangeend::timestamptz
-                ORDER BY "{m.order_by}" {m.sort}
-                OFFSET :offset
-                LIMIT :limit
-                ), t1 AS (
-                    SELECT
-                        location_id as "locationId",
-                        location,
-                        parameter,
-                        value,
-                        json_build_object(
-                            'utc',
-                            format_timestamp(datetime, 'UTC'),
-                            'local',
-                            format_timestamp(datetime, timezone)
-                        ) as date,
-                        unit,
-                        coordinates,
-                        country,
-                        city,
-                        ismobile as "isMobile"
-                    FROM t
-                )
-                SELECT {count}::bigint as count,
-                row_to_json(t1) as json FROM t1;
-            """
-
-            rows = await db.fetch(q, params)
-            if rows:
-                logger.debug(f"{len(rows)} rows found")
-                rc = rc + len(rows)
-                if len(rows) > 0 and rows[0][1] is not None:
-                    results.extend(
-                        [
-                            json.loads(r[1])
-                            for r in rows
-                            if isinstance(r[1], str)
-                        ]
-                    )
-            logger.debug(
-                f"ran query... {rc} {rangestart}"
-                f" {date_from_adj}{rangeend} {date_to_adj}"
-            )
-            if m.sort == "desc":
-                rangestart -= delta
-                rangeend -= delta
-            else:
-                rangestart += delta
-                rangeend += delta
-            logger.debug(
-                f"stepped ranges... {rc} {rangestart}"
-                f" {date_from_adj}{rangeend} {date_to_adj}"
-            )
-            params["rangestart"] = rangestart
-            params["rangeend"] = rangeend
-    meta = Meta(
-        website=os.getenv("APP_HOST", "/"),
-        page=m.page,
-        limit=m.limit,
-        found=count,
-    )
-
+    results = b"[]"
+    if count is None or count > 0:
+        windows = list(date_windows(date_from, date_to, WINDOW, m.sort))
+        logger.debug("count: %s windows: %s", count, len(windows))
+        if windows:
+            q = page_query(base_where, m.order_by, m.sort)
+            params["count"] = count
+            params["rangestarts"] = [w[0] for w in windows]
+            params["rangeends"] = [w[1] for w in windows]
+            row = await db.fetchrow(q, params)
+            results = row[1]
     if format == "csv":
         return Response(
-            content=meas_csv(results),
+            content=meas_csv(orjson.loads(results)),
             media_type="text/csv",
             headers={
                 "Content-Disposition": "attachment;filename=measurements.csv"
             },
         )
 
-    output = OpenAQResult(meta=meta, results=results)
-
-    # output = await db.fetchOpenAQResult(q, m.dict())
-
-    return output
+    # the page is spliced into the body as the database encoded it
+    return Response(
+        openaq_body(results, found=count, page=m.page, limit=m.limit),
+        media_type="application/json",
+    )
@@ -47,11 +47,16 @@ async def parameters_get(
     FROM measurands
     WHERE display is not null and is_core is not null
     ORDER BY "{parameters.order_by}" {parameters.sort}
-    )
-    SELECT count(*) OVER () as count,
-    jsonb_strip_nulls(to_jsonb(t)) as json FROM t
+    ),
+    page AS (
+    SELECT row_number() OVER () as n, jsonb_strip_nulls(to_jsonb(t)) as json
+    FROM t
     LIMIT :limit
     OFFSET :offset
+    )
+    SELECT (SELECT count(*) FROM t) as count,
+    COALESCE(jsonb_agg(json ORDER BY n), '[]'::jsonb) as results
+    FROM page
     """
 
     output = await db.fetchOpenAQResult(q, parameters.params())
@@ -20,39 +20,30 @@ class Projects(Project, Measurands, APIBase, Country):
 
     def where(self):
         wheres = []
-        for f, v in self:
-            if v is not None:
-                logger.debug(f" setting where for {f} {v} ")
-                if f == "project" and all(isinstance(x, int) for x in v):
-                    logger.debug(" using int id")
-                    wheres.append(" groups_id = ANY(:project) ")
-                elif f == "project":
-                    wheres.append(" g.name = ANY(:project) ")
-                elif f == "units":
-                    wheres.append(" units = ANY(:units) ")
-
-                elif f == "parameter":
-                    if all(isinstance(x, int) for x in v):
-                        wheres.append(
-                            """
-                            measurands_id = ANY (:parameter)
-                            """
-                        )
-                    else:
-                        wheres.append(
-                            """
-                            measurand = ANY (:parameter)
-                            """
-                        )
-                elif f == "country":
-                    wheres.append(
-                        """
-                        countries && :country
-                        """
-                    )
-
-                # elif isinstance(v, List):
-                #    wheres.append(f"{f} = ANY(:{f})")
+        if self.project is not None:
+            if all(isinstance(x, int) for x in self.project):
+                wheres.append(" groups_id = ANY(:project) ")
+            else:
+                wheres.append(" g.name = ANY(:project) ")
+        if self.parameter is not None:
+            if all(isinstance(x, int) for x in self.parameter):
+                wheres.append(
+                    """
+                    measurands_id = ANY (:parameter)
+                    """
+                )
+            else:
+                wheres.append(
+                    """
+                    measurand = ANY (:parameter)
+                    """
+                )
+        if self.country is not None:
+            wheres.append(
+                """
+                countries && :country
+                """
+            )
 
         if len(wheres) > 0:
             return (" AND ").join(wheres)
@@ -135,7 +126,8 @@ async def projects_get(
             FROM bysensor
             GROUP BY 1,2,3
         )
-        select count(*) OVER () as count,
+        , page as (
+        select row_number() OVER () as n,
         --jsonb_strip_nulls(
             to_jsonb(overall)
         --)
@@ -143,6 +135,10 @@ async def projects_get(
         from overall
         LIMIT :limit
         OFFSET :offset
+        )
+        select (select count(*) from overall) as count,
+        COALESCE(jsonb_agg(json ORDER BY n), '[]'::jsonb) as results
+        from page
             ;
     """
 
@@ -1,5 +1,5 @@
 import logging
-from typing import Optional
+from typing import List, Optional
 
 from fastapi import APIRouter, Depends, Path, Query
 from fastapi.responses import HTMLResponse
@@ -33,15 +33,12 @@ class Sources(SourceName, APIBase):
 
     def where(self):
         wheres = []
-        for f, v in self:
-            if v is not None:
-                logger.debug(f" setting where for {f} {v} ")
-                if f == "sourceId":
-                    wheres.append(" sources_id = ANY(:source_id) ")
-                elif f == "sourceName":
-                    wheres.append(" sources.name = ANY(:source_name) ")
-                elif f == "sourceSlug":
-                    wheres.append(" sources.slug = ANY(:source_slug) ")
+        if self.sourceName is not None:
+            wheres.append(" sources.name = ANY(:source_name) ")
+        if self.sourceId is not None:
+            wheres.append(" sources_id = ANY(:source_id) ")
+        if self.sourceSlug is not None:
+            wheres.append(" sources.slug = ANY(:source_slug) ")
         if len(wheres) > 0:
             return (" AND ").join(wheres)
         return " TRUE "
@@ -83,13 +80,17 @@ async def sources_get(
     OFFSET :offset
     LIMIT :limit
     )
-    SELECT count(*) OVER () as count,
-        to_jsonb(t) FROM t;
+    SELECT count(*) as count,
+        convert_to(COALESCE(
+            jsonb_agg(
+                to_jsonb(t) ORDER BY "{sources.order_by}" {sources.sort}
+            ),
+            '[]'::jsonb
+        )::text, 'UTF8') as results
+    FROM t;
     """
 
-    output = await db.fetchOpenAQResult(q, qparams)
-
-    return output
+    return await db.fetchOpenAQResponse(q, qparams)
 
 
 class SourcesV1Order(str, Enum):
@@ -97,17 +98,12 @@ class SourcesV1Order(str, Enum):
 
 
 class SourcesV1(APIBase):
-    name: Optional[str] = None
+    name: Optional[List[str]] = None
     order_by: SourcesV1Order = Query("name")
 
     def where(self):
-        wheres = []
-        for f, v in self:
-            if v is not None:
-                if f == "name":
-                    wheres.append(" source_name = ANY(:name) ")
-        if len(wheres) > 0:
-            return (" AND ").join(wheres)
+        if self.name is not None:
+            return " source_name = ANY(:name) "
         return " TRUE "
 
 
@@ -126,20 +122,22 @@ async def sources_v1_get(
     q = f"""
     WITH t AS (
     SELECT
-        data
+        COALESCE(data::jsonb, '{{}}'::jsonb) as data,
+        {ob} as o
     FROM sources_from_openaq
     WHERE {sources.where()}
     ORDER BY {ob}
     LIMIT :limit
     OFFSET :offset
     )
-    SELECT count(*) OVER () as count,
-        data FROM t;
+    SELECT count(*) as count,
+        convert_to(COALESCE(
+            jsonb_agg(data ORDER BY o), '[]'::jsonb
+        )::text, 'UTF8') as results
+    FROM t;
     """
 
-    output = await db.fetchOpenAQResult(q, qparams)
-
-    return output
+    return await db.fetchOpenAQResponse(q, qparams)
 
 
 @router.get("/v2/sources/readme/{slug}", tags=["v2"])
@@ -13,6 +13,18 @@ class Settings(BaseSettings):
     TESTLOCAL: bool = True
     OPENAQ_FETCH_BUCKET: str
     OPENAQ_ETL_BUCKET: str
+    # api connection pool, the defaults suit a single lambda instance
+    DATABASE_POOL_MIN: int = 1
+    DATABASE_POOL_MAX: int = 10
+    DATABASE_POOL_INACTIVE_LIFETIME: float = 15
+    # local server, reload is for development and cannot use workers
+    API_RELOAD: bool = False
+    API_WORKERS: int = 1
+    # worker processes for parsing fetch files, 0 parses in process
+    FETCH_PARSE_PROCESSES: int = 0
+    # fetch files downloaded ahead of the one being copied, each is
+    # held decompressed in memory until it is copied
+    FETCH_PREFETCH_FILES: int = 2
 
     class Config:
         env_file = env_file
@@ -18,7 +18,6 @@ setup(
         "pypika",
         "asyncpg",
         "pydantic[dotenv]",
-        "buildpg",
         "aiocache",
         "jq",
         "orjson",
@@ -36,6 +35,7 @@ setup(
         "pyhumps",
     ],
     extras_require={
+        "server": ["uvicorn[standard]"],
         "dev": [
             "black",
             "flake8",
@@ -0,0 +1,245 @@
+import io
+import struct
+from datetime import datetime, timedelta, timezone
+
+import orjson
+import psycopg2
+import pytest
+
+from openaq_fastapi.ingest import fetch
+from openaq_fastapi.ingest.utils import (
+    COPY_HEADER,
+    COPY_TRAILER,
+    NULL,
+    copy_bool,
+    copy_float8,
+    copy_int4,
+    copy_jsonb,
+    copy_point,
+    copy_text,
+    copy_timestamptz,
+    get_query,
+    parse_timestamp,
+)
+from openaq_fastapi.settings import settings
+
+UTC = timezone.utc
+
+# microseconds from 2000-01-01 to 2021-01-01, 21 years with 6 leap days
+US_2021 = (21 * 365 + 6) * 86400 * 1000000
+
+
+def field(b):
+    """A binary COPY field, the int32 length then the value."""
+    return struct.pack(">i", len(b)) + b
+
+
+def test_copy_header_and_trailer():
+    # signature, flags and header extension length
+    assert COPY_HEADER == b"PGCOPY\n\xff\r\n\x00" + b"\x00" * 8
+    assert COPY_TRAILER == b"\xff\xff"
+    assert NULL == b"\xff\xff\xff\xff"
+
+
+def test_copy_text():
+    assert copy_text("Delhi") == b"\x00\x00\x00\x05Delhi"
+    assert copy_text("µg/m³") == field("µg/m³".encode())
+    assert copy_text(None) == NULL
+    assert copy_text("") == NULL
+    assert copy_text(42) == field(b"42")
+
+
+def test_copy_numbers():
+    assert copy_float8(1.5) == field(struct.pack(">d", 1.5))
+    assert copy_float8("-0.25") == field(struct.pack(">d", -0.25))
+    assert copy_float8(None) == NULL
+    assert copy_int4(7) == b"\x00\x00\x00\x04\x00\x00\x00\x07"
+    assert copy_int4(-1) == b"\x00\x00\x00\x04\xff\xff\xff\xff"
+    assert copy_int4(None) == NULL
+
+
+def test_copy_bool():
+    assert copy_bool(True) == b"\x00\x00\x00\x01\x01"
+    assert copy_bool(False) == b"\x00\x00\x00\x01\x00"
+    assert copy_bool("true") == copy_bool(True)
+    assert copy_bool(" F ") == copy_bool(False)
+    assert copy_bool(None) == NULL
+
+
+def test_copy_jsonb():
+    assert copy_jsonb(b"{}") == b"\x00\x00\x00\x03\x01{}"
+
+
+def test_copy_timestamptz():
+    assert copy_timestamptz(datetime(2000, 1, 1, tzinfo=UTC)) == field(
+        struct.pack(">q", 0)
+    )
+    assert copy_timestamptz(datetime(2021, 1, 1, tzinfo=UTC)) == field(
+        struct.pack(">q", US_2021)
+    )
+    # before the postgres epoch is negative
+    assert copy_timestamptz(
+        datetime(1999, 12, 31, 23, 59, 59, 500000, tzinfo=UTC)
+    ) == field(struct.pack(">q", -500000))
+    assert copy_timestamptz(None) == NULL
+
+
+def test_timestamps_with_timezones():
+    expected = datetime(2021, 1, 1, tzinfo=UTC)
+    for value in (
+        "2021-01-01T00:00:00Z",
+        "2021-01-01T00:00:00.000Z",
+        "2021-01-01T05:30:00+05:30",
+        "2020-12-31T19:00:00-05:00",
+        # no offset is taken as utc
+        "2021-01-01T00:00:00",
+    ):
+        assert parse_timestamp(value) == expected, value
+        assert copy_timestamptz(parse_timestamp(value)) == field(
+            struct.pack(">q", US_2021)
+        )
+    assert parse_timestamp("2021-01-01T05:30:00+05:30").utcoffset() == (
+        timedelta(hours=5, minutes=30)
+    )
+
+
+def test_copy_point():
+    # little endian ewkb point with the srid flag set, then the srid
+    ewkb = (
+        b"\x01"
+        + struct.pack("<I", 0x20000001)
+        + struct.pack("<I", 4326)
+        + struct.pack("<dd", -70.5, -33.25)
+    )
+    assert copy_point(-70.5, -33.25) == field(ewkb)
+    assert copy_point("-70.5", "-33.25") == field(ewkb)
+    assert copy_point(None, -33.25) == NULL
+    assert copy_point(-70.5, None) == NULL
+
+
+MEASUREMENT = {
+    "location": "Parque O'Higgins",
+    "value": 12.5,
+    "unit": "µg/m³",
+    "parameter": "pm25",
+    "country": "CL",
+    "city": "",
+    "sourceName": "Chile - SINCA",
+    "date": {
+        "utc": "2021-01-01T00:00:00.000Z",
+        "local": "2020-12-31T21:00:00-03:00",
+    },
+    "sourceType": "government",
+    "mobile": False,
+    "coordinates": {"latitude": -33.25, "longitude": -70.5},
+    "averagingPeriod": {"unit": "hours", "value": 1},
+    "attribution": [{"name": "SINCA"}],
+}
+
+
+def test_parse_json_row():
+    row, data = fetch.parse_json(orjson.loads(orjson.dumps(MEASUREMENT)))
+    assert row == b"".join(
+        (
+            struct.pack(">h", 14),
+            field("Parque O'Higgins".encode()),
+            field(struct.pack(">d", 12.5)),
+            field("µg/m³".encode()),
+            field(b"pm25"),
+            field(b"CL"),
+            # empty strings are copied as null
+            NULL,
+            field(b"Chile - SINCA"),
+            field(struct.pack(">q", US_2021)),
+            field(
+                b"\x01"
+                + struct.pack("<IIdd", 0x20000001, 4326, -70.5, -33.25)
+            ),
+            field(b"government"),
+            field(b"\x00"),
+            field(b"hours"),
+            field(struct.pack(">d", 1.0)),
+        )
+    )
+    # everything not copied to its own column is kept as the data object
+    assert orjson.loads(data) == {"attribution": [{"name": "SINCA"}]}
+
+
+def test_parse_json_nulls():
+    row, data = fetch.parse_json(
+        {"location": "x", "value": None, "date": {"utc": None}}
+    )
+    # the field count includes the data_id appended by with_data_ids
+    assert row == struct.pack(">h", 14) + field(b"x") + NULL * 12
+    assert data == b"{}"
+
+
+def test_parse_json_outside_bounds():
+    j = orjson.loads(orjson.dumps(MEASUREMENT))
+    start = datetime(2021, 1, 1, tzinfo=UTC)
+    assert fetch.parse_json(dict(j), start=start) is None
+    assert fetch.parse_json(dict(j), end=start - timedelta(seconds=1)) is None
+    assert fetch.parse_json(dict(j), start=start - timedelta(seconds=1))
+
+
+@pytest.fixture
+def cursor():
+    """A cursor on the write database, skipped when there is none."""
+    try:
+        connection = psycopg2.connect(settings.DATABASE_WRITE_URL)
+    except psycopg2.Error as e:
+        pytest.skip(f"no database: {e}")
+    try:
+        with connection.cursor() as cursor:
+            yield cursor
+    finally:
+        connection.rollback()
+        connection.close()
+
+
+def test_copy_round_trip(cursor):
+    cursor.execute(get_query("fetch_staging.sql"))
+    lines = io.BytesIO(
+        orjson.dumps(MEASUREMENT)
+        + b"\n"
+        + orjson.dumps({"location": "x", "date": {"utc": None}})
+        + b"\n"
+    )
+    data_ids = {}
+    rows = fetch.with_data_ids(fetch.parse_lines(lines), data_ids)
+    cursor.copy_expert(get_query("fetch_copy.sql"), fetch.copy_stream(rows))
+    cursor.copy_expert(
+        get_query("fetch_copy_data.sql"),
+        fetch.copy_stream(fetch.data_rows(data_ids)),
+    )
+    cursor.execute(
+        """
+        SELECT
+            location, value, unit, parameter, country, city, source_name,
+            datetime, st_x(coords::geometry), st_y(coords::geometry),
+            source_type, mobile, avpd_unit, avpd_value, data
+        FROM tempfetchdata
+        LEFT JOIN tempfetchdata_data USING (data_id)
+        ORDER BY location
+        """
+    )
+    assert cursor.fetchall() == [
+        (
+            "Parque O'Higgins",
+            12.5,
+            "µg/m³",
+            "pm25",
+            "CL",
+            None,
+            "Chile - SINCA",
+            datetime(2021, 1, 1, tzinfo=UTC),
+            -70.5,
+            -33.25,
+            "government",
+            False,
+            "hours",
+            1.0,
+            {"attribution": [{"name": "SINCA"}]},
+        ),
+        ("x",) + (None,) * 13 + ({},),
+    ]
@@ -0,0 +1,56 @@
+from openaq_fastapi.db import positional
+
+
+def test_names_become_positions():
+    assert positional("SELECT * FROM t WHERE a = :a AND b = :b") == (
+        "SELECT * FROM t WHERE a = $1 AND b = $2",
+        ("a", "b"),
+    )
+
+
+def test_casts_are_kept():
+    assert positional("SELECT :date_from::timestamptz, x::text") == (
+        "SELECT $1::timestamptz, x::text",
+        ("date_from",),
+    )
+
+
+def test_any_with_array_cast():
+    assert positional("WHERE iso = ANY(:country::text[])") == (
+        "WHERE iso = ANY($1::text[])",
+        ("country",),
+    )
+
+
+def test_repeated_names_bind_each_position():
+    query, names = positional(
+        "WHERE a > :limit OR b < :limit OFFSET :offset LIMIT :limit"
+    )
+    assert query == "WHERE a > $1 OR b < $2 OFFSET $3 LIMIT $4"
+    assert names == ("limit", "limit", "offset", "limit")
+
+
+def test_array_literals_are_kept():
+    # the routers format queries so literal braces are doubled there
+    for literal in ("'{o,st}'::text[]", "'{{o,st}}'::text[]"):
+        query = f"WHERE x = ANY({literal}) AND y = :y"
+        assert positional(query) == (
+            f"WHERE x = ANY({literal}) AND y = $1",
+            ("y",),
+        )
+
+
+def test_names_in_string_literals_are_kept():
+    assert positional(
+        "SELECT ':a', 'it''s :b', to_char(:c, 'HH24:MI:SS') WHERE d = :d"
+    ) == (
+        "SELECT ':a', 'it''s :b', to_char($1, 'HH24:MI:SS') WHERE d = $2",
+        ("c", "d"),
+    )
+
+
+def test_time_literals_and_slices():
+    assert positional("SELECT '00:00'::time, a[1:2], b[:n]") == (
+        "SELECT '00:00'::time, a[1:2], b[$1]",
+        ("n",),
+    )
@@ -0,0 +1,83 @@
+import io
+
+import pytest
+
+from openaq_fastapi.ingest import fetch
+
+
+class FakeCursor:
+    """
+    Cursor standing in for psycopg2, COPY reads the whole stream and
+    fails when it holds a row from a file marked bad.
+    """
+
+    statusmessage = "COPY 1"
+
+    def __init__(self):
+        self.statements = []
+        self.copied = []
+
+    def execute(self, query, params=None):
+        self.statements.append(query)
+
+    def fetchone(self):
+        if "max(data_id)" in self.statements[-1]:
+            return (0,)
+        return (None, None)
+
+    def copy_expert(self, query, stream, size=None):
+        data = stream.read()
+        if b"bad" in data:
+            raise ValueError("bad row")
+        self.copied.append(data)
+
+
+@pytest.fixture
+def ingest(monkeypatch):
+    """Record the keys copy_files marks as loaded and failed."""
+    loaded, failed = [], []
+    monkeypatch.setattr(fetch, "get_query", lambda name: name)
+    monkeypatch.setattr(
+        fetch,
+        "parse_lines",
+        lambda f, start, end: [(f.getvalue(), b"{}")],
+    )
+    monkeypatch.setattr(
+        fetch, "load_success", lambda cursor, key, status: loaded.append(key)
+    )
+    monkeypatch.setattr(
+        fetch, "load_fail", lambda cursor, key, e: failed.append(key)
+    )
+    return loaded, failed
+
+
+def fake_download(key):
+    if key == "missing":
+        raise OSError("download failed")
+    return io.BytesIO(key.encode())
+
+
+def test_failed_download_does_not_drop_the_rest_of_the_batch(
+    monkeypatch, ingest
+):
+    loaded, failed = ingest
+    monkeypatch.setattr(fetch, "download", fake_download)
+    keys = ["a", "b", "missing", "c", "d"]
+
+    fetch.copy_files(FakeCursor(), fetch.prefetch(keys))
+
+    assert loaded == ["a", "b", "c", "d"]
+    assert failed == ["missing"]
+
+
+def test_bad_file_only_fails_itself(monkeypatch, ingest):
+    loaded, failed = ingest
+    monkeypatch.setattr(fetch, "download", fake_download)
+    keys = ["a", "bad", "missing", "c"]
+    cursor = FakeCursor()
+
+    fetch.copy_files(cursor, fetch.prefetch(keys))
+
+    assert sorted(loaded) == ["a", "c"]
+    assert sorted(failed) == ["bad", "missing"]
+    assert "ROLLBACK TO SAVEPOINT copy_files;" in cursor.statements
@@ -0,0 +1,205 @@
+import pytest
+
+from openaq_fastapi.db import positional
+from openaq_fastapi.routers.cities import Cities
+from openaq_fastapi.routers.countries import Countries
+from openaq_fastapi.routers.locations import Locations
+from openaq_fastapi.routers.projects import Projects
+from openaq_fastapi.routers.sources import Sources, SourcesV1
+
+
+def clauses(model):
+    """The where clause split on AND, with whitespace collapsed."""
+    where = " ".join(model.where().split())
+    return where.split(" AND ")
+
+
+def check(model, expected_clauses, expected_params):
+    assert clauses(model) == expected_clauses
+    params = model.params()
+    for name, value in expected_params.items():
+        assert params[name] == value
+    # every placeholder in the clause must have a value to bind
+    _, names = positional(model.where())
+    assert set(names) <= set(params)
+
+
+@pytest.mark.parametrize(
+    "kwargs,expected,params",
+    [
+        ({}, ["TRUE"], {}),
+        ({"country": ["us", "MX"]}, ["cl.iso = ANY(:country)"],
+         {"country": ["US", "MX"]}),
+        ({"country_id": "us", "country": None}, ["cl.iso = ANY(:country)"],
+         {"country": ["US"]}),
+    ],
+)
+def test_countries(kwargs, expected, params):
+    check(Countries(**kwargs), expected, params)
+
+
+@pytest.mark.parametrize(
+    "kwargs,expected,params",
+    [
+        ({}, ["TRUE"], {}),
+        ({"city": ["Chicago"]}, ["city = ANY(:city)"],
+         {"city": ["Chicago"]}),
+        ({"country": ["us"]}, ["country = ANY(:country)"],
+         {"country": ["US"]}),
+        (
+            {"city": ["Chicago", "Boston"], "country": ["US"]},
+            ["city = ANY(:city)", "country = ANY(:country)"],
+            {"city": ["Chicago", "Boston"], "country": ["US"]},
+        ),
+    ],
+)
+def test_cities(kwargs, expected, params):
+    check(Cities(**kwargs), expected, params)
+
+
+@pytest.mark.parametrize(
+    "kwargs,expected,params",
+    [
+        ({}, ["TRUE"], {}),
+        ({"sourceName": ["AirNow"]}, ["sources.name = ANY(:source_name)"],
+         {"source_name": ["AirNow"]}),
+        ({"sourceId": [1, 2]}, ["sources_id = ANY(:source_id)"],
+         {"source_id": [1, 2]}),
+        ({"sourceSlug": ["airnow"]}, ["sources.slug = ANY(:source_slug)"],
+         {"source_slug": ["airnow"]}),
+        (
+            {"sourceName": ["AirNow"], "sourceId": [1],
+             "sourceSlug": ["airnow"]},
+            [
+                "sources.name = ANY(:source_name)",
+                "sources_id = ANY(:source_id)",
+                "sources.slug = ANY(:source_slug)",
+            ],
+            {"source_name": ["AirNow"], "source_id": [1],
+             "source_slug": ["airnow"]},
+        ),
+    ],
+)
+def test_sources(kwargs, expected, params):
+    check(Sources(**kwargs), expected, params)
+
+
+@pytest.mark.parametrize(
+    "kwargs,expected,params",
+    [
+        ({}, ["TRUE"], {}),
+        ({"name": ["AirNow"]}, ["source_name = ANY(:name)"],
+         {"name": ["AirNow"]}),
+    ],
+)
+def test_sources_v1(kwargs, expected, params):
+    check(SourcesV1(**kwargs), expected, params)
+
+
+@pytest.mark.parametrize(
+    "kwargs,expected,params",
+    [
+        ({}, ["TRUE"], {}),
+        ({"project": [1, 2]}, ["groups_id = ANY(:project)"],
+         {"project": [1, 2]}),
+        ({"project_id": 3, "project": None}, ["groups_id = ANY(:project)"],
+         {"project": [3]}),
+        ({"project": ["openaq"]}, ["g.name = ANY(:project)"],
+         {"project": ["openaq"]}),
+        ({"parameter": [2]}, ["measurands_id = ANY (:parameter)"],
+         {"parameter": [2]}),
+        ({"parameter": ["pm25"]}, ["measurand = ANY (:parameter)"],
+         {"parameter": ["pm25"]}),
+        ({"country": ["us"]}, ["countries && :country"],
+         {"country": ["US"]}),
+        (
+            {"project": [1], "parameter": ["pm25"], "country": ["US"]},
+            [
+                "groups_id = ANY(:project)",
+                "measurand = ANY (:parameter)",
+                "countries && :country",
+            ],
+            {"project": [1], "parameter": ["pm25"], "country": ["US"]},
+        ),
+    ],
+)
+def test_projects(kwargs, expected, params):
+    check(Projects(**kwargs), expected, params)
+
+
+GEO = "st_dwithin(st_makepoint(:lon, :lat)::geography, geog, :radius)"
+
+
+@pytest.mark.parametrize(
+    "kwargs,expected,params",
+    [
+        ({}, ["TRUE"], {}),
+        (
+            {"parameter": [2]},
+            ["parameters @> ANY( jsonb_array_query('parameterId',"
+             ":parameter::int[]) )"],
+            {"parameter": [2]},
+        ),
+        (
+            {"parameter": ["pm25"]},
+            ["parameters @> ANY( jsonb_array_query('parameter',"
+             ":parameter::text[]) )"],
+            {"parameter": ["pm25"]},
+        ),
+        (
+            {"unit": ["ppm"]},
+            ["parameters @> ANY( jsonb_array_query('unit',:unit::text[]) )"],
+            {"unit": ["ppm"]},
+        ),
+        (
+            {"country": ["us"], "city": ["Chicago"]},
+            ["country = ANY(:country)", "city = ANY(:city)"],
+            {"country": ["US"], "city": ["Chicago"]},
+        ),
+        ({"location": [8118]}, ["id = ANY(:location)"],
+         {"location": [8118]}),
+        ({"location": ["Chicago"]}, ["name = ANY(:location)"],
+         {"location": ["Chicago"]}),
+        ({"isMobile": False}, ['"isMobile" = False'], {}),
+        ({"isMobile": True}, ['"isMobile" = True'], {}),
+        (
+            {"sourceName": ["AirNow"]},
+            ["sources @> ANY( jsonb_array_query('name',:source_name::text[])"
+             " || jsonb_array_query('id',:source_name::text[]) )"],
+            {"source_name": ["AirNow"]},
+        ),
+        ({"entity": ["government"]}, ["entity = ANY(:entity)"],
+         {"entity": ["government"]}),
+        (
+            {"sensorType": ["reference"]},
+            ['"sensorType" = ANY(:sensor_type)'],
+            {"sensor_type": ["reference"]},
+        ),
+        (
+            {"modelName": ["PA-II"]},
+            ["manufacturers @> ANY( jsonb_array_query('modelName',"
+             ":model_name::text[]) )"],
+            {"model_name": ["PA-II"]},
+        ),
+        (
+            {"manufacturerName": ["PurpleAir"]},
+            ["manufacturers @> ANY( jsonb_array_query('manufacturerName',"
+             ":manufacturer_name::text[]) )"],
+            {"manufacturer_name": ["PurpleAir"]},
+        ),
+        (
+            {"coordinates": "41.87,-87.62", "radius": 5000},
+            [GEO],
+            {"lat": 41.87, "lon": -87.62, "radius": 5000},
+        ),
+        (
+            {"country": ["US"], "location": [8118],
+             "coordinates": "41.87,-87.62", "radius": 1000},
+            ["country = ANY(:country)", "id = ANY(:location)", GEO],
+            {"country": ["US"], "location": [8118], "lat": 41.87,
+             "lon": -87.62},
+        ),
+    ],
+)
+def test_locations(kwargs, expected, params):
+    check(Locations(**kwargs), expected, params)